@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+"""Time one water iteration of deltaRCM with different numbers of workers.
+
+The parcels of an iteration are routed in n_workers chunks on a pool of
+threads (see Tools.run_water_iteration), so the speedup over one worker
+is bounded by the number of CPUs. Run with
+
+    python benchmarks/water_routing.py [--workers 1 2 4] [--parcels 20000]
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import multiprocessing
+
+from deltaRCM.small_delta import make_model
+
+
+def time_water_iteration(n_workers, n_parcels, n_repeat):
+    """Best time of n_repeat water iterations with n_workers threads.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of threads routing the parcels.
+    n_parcels : int
+        Number of water parcels.
+    n_repeat : int
+        Number of timed iterations.
+
+    Returns
+    -------
+    float
+        Seconds of the fastest iteration.
+    """
+    out_dir = tempfile.mkdtemp()
+    try:
+        model = make_model(out_dir, model_grid__length=3000.,
+                           model_grid__width=6000., model_grid__cell_size=50.,
+                           water__number_parcels=n_parcels,
+                           model__number_workers=n_workers)
+
+        # a spun-up flow field, so the parcels take realistic paths
+        model.advance_in_time()
+        model.init_water_iteration()
+
+        times = timeit.repeat(model.run_water_iteration, number=1,
+                              repeat=n_repeat)
+        model.finalize()
+    finally:
+        shutil.rmtree(out_dir)
+
+    return min(times)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='numbers of workers to time')
+    parser.add_argument('--parcels', type=int, default=20000,
+                        help='number of water parcels')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed iterations')
+
+    args = parser.parse_args()
+
+    print('%d CPUs, %d parcels' % (multiprocessing.cpu_count(), args.parcels))
+    print('%8s %10s %8s' % ('workers', 'seconds', 'speedup'))
+
+    base = None
+    for n_workers in args.workers:
+        seconds = time_water_iteration(n_workers, args.parcels, args.repeat)
+        if base is None:
+            base = seconds
+        print('%8d %10.3f %8.2f' % (n_workers, seconds, base / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -24,7 +24,7 @@ class BmiDeltaRCM(Bmi):
         self._grids = {}
         self._grid_type = {}
 
-    def initialize(self):
+    def initialize(self, filename=None):
         """Initialize the deltaRCM model.
 
         Parameters
@@ -33,7 +33,7 @@ class BmiDeltaRCM(Bmi):
             Path to name of input file.
         
         """
-        self._model = DeltaRCM()
+        self._model = DeltaRCM(filename)
 
         self._values = {
             'surface__elevation': self._model.eta,
@@ -91,8 +91,31 @@ class BmiDeltaRCM(Bmi):
 
     def finalize(self):
         """Finalize model."""
+        self._model.finalize()
         self._model = None
 
+    def save_checkpoint(self, filename):
+        """Save the state of the model.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the checkpoint file.
+        """
+        self._model.save_checkpoint(filename)
+
+    def load_checkpoint(self, filename):
+        """Restore the state of the model from a checkpoint.
+
+        The model must have been initialized with the same grid.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the checkpoint file.
+        """
+        self._model.load_checkpoint(filename)
+
     def get_var_type(self, var_name):
         """Data type of variable.
 
@@ -16,22 +16,29 @@ class DeltaRCM(deltaRCM_base.Tools):
     
     """
     
-    def __init__(self):
+    def __init__(self, input_file = None):
         '''
         Creates a new delta model
+
+        input_file : path of the input file (defaults to the example
+        input file of the deltaRCM repository)
         '''
         
         self._time = 0.
         self._time_step = 1.
         self.verbose = False
         self.input_file = 'https://raw.githubusercontent.com/mperignon/deltaRCM/master/component/deltaRCM.in'
+        if input_file is not None:
+            self.input_file = input_file
         self.Np_water = 0
+        self._iterations_used = 0
         self.create_dicts()
         self.set_defaults()
         self.import_file()
         
         self.create_other_variables()
         self.create_domain()
+        self.init_warm_start()
         
         
         
@@ -61,6 +68,13 @@ class DeltaRCM(deltaRCM_base.Tools):
         
         
 
+    @property
+    def iterations_used(self):
+        """Number of water iterations run in the last time step."""
+        return self._iterations_used
+
+
+
     @property
     def Parcels_water(self):
         """Temperature of the plate."""
@@ -120,6 +134,14 @@ class DeltaRCM(deltaRCM_base.Tools):
         self._time += self._time_step
 
 
+
+    def finalize(self):
+        """Write the remaining output, close the output files and stop the workers."""
+
+        self.close_output()
+        self.close_pool()
+
+
     
     #############################################
     ############# run_one_timestep ##############
@@ -134,20 +156,44 @@ class DeltaRCM(deltaRCM_base.Tools):
         print 'Time = ' + str(timestep) + ' of ' + str(self.n_steps)
 
 
-        for iteration in range(self.itermax):
+        # a flow field from the warm start cache is already spun up,
+        # so the first timestep goes straight to the sediment
+        n_iterations = self.itermax
+        if self._warm_started:
+            n_iterations = 0
+            self._warm_started = False
+
+        self._iterations_used = 0
+
+        for iteration in range(n_iterations):
+
+            if self.conv_tol > 0:
+                qwn_old = self.qwn.copy()
 
             self.init_water_iteration()
             self.run_water_iteration()
 
-            if timestep>0:
+            if self._spun_up:
                 self.get_profiles()
 
             self.finalize_water_iteration(timestep, iteration)
 
+            self._iterations_used = iteration + 1
+
+            # stop once the flow field has settled between iterations
+            if self.conv_tol > 0 and iteration > 0:
+                if self.flow_change(qwn_old) < self.conv_tol:
+                    break
+
+        if self.verbose:
+            print 'Water iterations: ' + str(self._iterations_used)
+
+        if not self._spun_up:
+            self.finalize_spin_up()
+
         self.init_sed_timestep()
 
-        self.one_coarse_timestep()
-        self.one_fine_timestep()
+        self.one_sed_timestep()
 
         self.finalize_sed_timestep()
 
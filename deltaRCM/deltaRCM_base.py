@@ -1,12 +1,28 @@
 from math import floor, sqrt
 import numpy as np
-from random import shuffle
-from matplotlib import pyplot as plt
-from scipy import ndimage
 import sys, os, re, string
-import pickle
+import json, hashlib
+import atexit, weakref
+from multiprocessing.pool import ThreadPool
+
+from deltaRCM_tools import save_figure, save_grid_figure, random_pick_batch
+from deltaRCM_tools import flat_walk, neighbor_table, scatter_add, unique_rounds
+from deltaRCM_tools import uniform_filter
+from deltaRCM_tools import PathStore, CellCounts, VisitedCells, GridWriter, OutputQueue, RandomStreams
+from deltaRCM_tools import write_checkpoint, read_checkpoint
+from deltaRCM_tools import GridFigure, write_png
+
+def close_output_at_exit(model_ref):
+    '''
+    Finish the output of the model model_ref refers to, if it still exists
+    '''
+
+    model = model_ref()
+
+    if model is not None:
+        model.close_output()
+
 
-from deltaRCM_tools import save_figure, random_pick, random_pick_list
 
 class Tools(object):
 
@@ -21,6 +37,9 @@ class Tools(object):
         'land_surface__width': {'name':'L0_meters', 'type': 'float', 'default': 30.}, 
         'land_surface__slope': {'name':'S0', 'type': 'float', 'default': 0.00015},
         'model__max_iteration': {'name':'itermax', 'type': 'long', 'default': 3},
+        'model__random_seed': {'name':'seed', 'type': 'long', 'default': 0},
+        'model__number_workers': {'name':'n_workers', 'type': 'long', 'default': 1},
+        'model__convergence_tolerance': {'name':'conv_tol', 'type': 'float', 'default': 0.0},
         'water__number_parcels': {'name':'Np_water', 'type': 'long', 'default': 200},
         'channel__flow_velocity': {'name':'u0', 'type': 'float', 'default': 1.},
         'channel__width': {'name':'N0_meters', 'type': 'float', 'default': 50.},
@@ -36,7 +55,10 @@ class Tools(object):
         'model_output__opt_eta_grids': {'name':'save_eta_grids', 'type': 'choice', 'default': False},
         'model_output__opt_stage_grids': {'name':'save_stage_grids', 'type': 'choice', 'default': False},
         'model_output__opt_depth_grids': {'name':'save_depth_grids', 'type': 'choice', 'default': False},
+        'model_output__opt_discharge_grids': {'name':'save_discharge_grids', 'type': 'choice', 'default': False},
+        'model_output__opt_deposit_grids': {'name':'save_deposit_grids', 'type': 'choice', 'default': False},
         'model_output__opt_time_interval': {'name':'save_dt', 'type': 'long', 'default': 10},
+        'model_output__figure_mode': {'name':'figure_mode', 'type': 'string', 'default': 'pcolor'},
         'coeff__surface_smoothing': {'name': 'Csmooth', 'type': 'float', 'default': 0.9},
         'coeff__under_relaxation__water_surface': {'name': 'omega_sfc', 'type': 'float', 'default': 0.1},
         'coeff__under_relaxation__water_flow': {'name': 'omega_flow', 'type': 'float', 'default': 0.9},
@@ -49,10 +71,26 @@ class Tools(object):
         'coeff__velocity_deposition_mud': {'name': 'coeff_U_dep_mud', 'type': 'float', 'default': 0.3},
         'coeff__velocity_erosion_mud': {'name': 'coeff_U_ero_mud', 'type': 'float', 'default': 1.5},
         'coeff__velocity_erosion_sand': {'name': 'coeff_U_ero_sand', 'type': 'float', 'default': 1.05},
-        'coeff__topographic_diffusion': {'name': 'alpha', 'type': 'float', 'default': 0.1}
+        'coeff__topographic_diffusion': {'name': 'alpha', 'type': 'float', 'default': 0.1},
+        'water__opt_outlet_paths_only': {'name': 'outlet_paths_only', 'type': 'choice', 'default': True},
+        'model__warm_start_dir': {'name': 'warm_start_dir', 'type': 'string', 'default': ''}
         }
 
 
+    # (neighbor, cell) slices of an (L,W) array such that array[neighbor]
+    # are the values of the neighbor of array[cell] in each direction
+    _nh_slices = [
+        ((slice(None), slice(1,None)), (slice(None), slice(None,-1))), # E
+        ((slice(None,-1), slice(1,None)), (slice(1,None), slice(None,-1))), # NE
+        ((slice(None,-1), slice(None)), (slice(1,None), slice(None))), # N
+        ((slice(None,-1), slice(None,-1)), (slice(1,None), slice(1,None))), # NW
+        ((slice(None), slice(None,-1)), (slice(None), slice(1,None))), # W
+        ((slice(1,None), slice(None,-1)), (slice(None,-1), slice(1,None))), # SW
+        ((slice(1,None), slice(None)), (slice(None,-1), slice(None))), # S
+        ((slice(1,None), slice(1,None)), (slice(None,-1), slice(None,-1))) # SE
+        ]
+
+
     def flatten_indices(self, ind):
         '''Flatten indices'''
 
@@ -60,58 +98,228 @@ class Tools(object):
 
 
     def output_data(self, timestep):
+        '''
+        Queue the figures and grids of this timestep
+
+        They are rendered and written on the output thread from copies
+        of the grids, so the model can move on to the next timestep
+        '''
 
         if int(timestep+1) % self.save_dt == 0:
-    
-            if self.save_eta_figs:
-                    
-                plt.pcolor(self.eta)
-                plt.colorbar()
-                save_figure(self.prefix + "eta" + str(timestep+1))
-            
-            if self.save_stage_figs:
-                    
-                plt.pcolor(self.stage)
-                plt.colorbar()
-                save_figure(self.prefix + "stage" + str(timestep+1))
-                        
-            if self.save_depth_figs:
-                    
-                plt.pcolor(self.depth)
-                plt.colorbar()
-                save_figure(self.prefix + "depth" + str(timestep+1))
-                
-                
+
+            figs = []
+
+            if self.save_eta_figs: figs.append(('eta', self.eta))
+            if self.save_stage_figs: figs.append(('stage', self.stage))
+            if self.save_depth_figs: figs.append(('depth', self.depth))
+
+            for name, grid in figs:
+                self.output_queue().put(self.figure_writer(name),
+                    self.prefix + name + str(timestep+1), grid.copy())
+
+            self.save_grids()
+
+
+
+    def figure_writer(self, name):
+        '''
+        Get the function that saves the figures of the grid name
+
+        figure_mode is 'pcolor' (a new pyplot-free pcolor plot each time),
+        'image' (one persistent imshow figure per grid) or
+        'png' (colormapped PNG written directly)
+        '''
+
+        if self.figure_mode == 'pcolor':
+            return save_grid_figure
+
+        if self.figure_mode == 'image':
+            if name not in self._figures:
+                self._figures[name] = GridFigure()
+            return self._figures[name].save
+
+        return write_png
+
+
+
+    def output_queue(self):
+        '''
+        Get the queue of output jobs, starting it if needed
+
+        The queued output is also finished and the grid files closed
+        when the interpreter exits, in case finalize is never called
+        '''
+
+        if self._output is None:
+            self._output = OutputQueue()
+
+        if not self._closed_at_exit:
+            atexit.register(close_output_at_exit, weakref.ref(self))
+            self._closed_at_exit = True
+
+        return self._output
+
+
+
+    def save_grids(self):
+        '''
+        Append the current grids selected in the input file
+        to their files in the output directory
+        '''
+
+        grids = []
+
+        if self.save_eta_grids: grids.append(('eta', self.eta))
+        if self.save_stage_grids: grids.append(('stage', self.stage))
+        if self.save_depth_grids: grids.append(('depth', self.depth))
+        if self.save_discharge_grids: grids.append(('discharge', self.qw))
+        if self.save_deposit_grids:
+            grids.append(('sand_deposit', self.Vp_dep_sand))
+            grids.append(('mud_deposit', self.Vp_dep_mud))
+
+        for name, grid in grids:
+
+            # after a restart, continue the files after the saved snapshots
+            if name not in self._grid_writers:
+                self._grid_writers[name] = GridWriter(self.prefix + name + '_grids',
+                    grid.shape, self.n_steps // self.save_dt, grid.dtype,
+                    size = self._grid_sizes.get(name, 0))
+
+            self.output_queue().put(self._grid_writers[name].append, grid.copy())
+
+
+
+    def close_output(self):
+        '''
+        Finish the queued output and close the grid files
+        '''
+
+        if self._output is None:
+            return
+
+        for writer in self._grid_writers.values():
+            self._output.put(writer.close)
+
+        self._grid_writers = {}
+
+        self._output.close()
+        self._output = None
+
+
+
+    #############################################
+    ############### active window ###############
+    #############################################
+
+    def full_window(self, window = None):
+        '''
+        Get window, or the window (rows, cols) of slices covering the domain
+        '''
+
+        if window is None:
+            window = (slice(0, self.L), slice(0, self.W))
+
+        return window
+
+
+
+    def expand_window(self, window, n):
+        '''
+        Grow window (rows, cols) by n cells on each side, within the domain
+
+        Returns the grown window and the slices of window inside of it, so
+        stencils can be computed on the grown window and kept on window
+        '''
+
+        rows, cols = window
+
+        r0 = max(rows.start - n, 0); r1 = min(rows.stop + n, self.L)
+        c0 = max(cols.start - n, 0); c1 = min(cols.stop + n, self.W)
+
+        grown = (slice(r0, r1), slice(c0, c1))
+        inner = (slice(rows.start - r0, rows.stop - r0),
+                 slice(cols.start - c0, cols.stop - c0))
+
+        return grown, inner
+
+
+
+    def update_active_window(self):
+        '''
+        Update the active window: the bounding box, with a halo of
+        window_halo cells, of the cells with flow or sediment discharge
+        now or at the previous update
+        '''
+
+        active = (self.qw != 0) | (self.qwn != 0) | (self.qs != 0)
+
+        rows = np.nonzero(np.any(active | self._active, axis=1))[0]
+        cols = np.nonzero(np.any(active | self._active, axis=0))[0]
+
+        self._active = active
+
+        window = (slice(rows[0], rows[-1]+1), slice(cols[0], cols[-1]+1))
+        self.active_window = self.expand_window(window, self.window_halo)[0]
+
 
 
     #############################################
     ############### weight arrays ###############
     #############################################
 
-    def build_weight_array(self, array, fix_edges = False, normalize = False):
+    def get_buffer(self, name, shape = None):
+        '''
+        Get a view of shape (default (8,L,W)) of the preallocated array
+        stored under name, which spans the whole domain in its last two
+        dimensions so windows of any size reuse it
+        '''
+
+        if shape is None:
+            shape = (8, self.L, self.W)
+
+        shape = tuple(shape)
+        full_shape = shape
+
+        if len(shape) >= 2 and shape[-2] <= self.L and shape[-1] <= self.W:
+            full_shape = shape[:-2] + (self.L, self.W)
+
+        buf = self._buffers.get(name)
+
+        if buf is None or buf.shape != full_shape:
+            buf = np.zeros(full_shape)
+            self._buffers[name] = buf
+
+        return buf[tuple(slice(0, n) for n in shape)]
+
+
+
+    def build_weight_array(self, array, fix_edges = False, normalize = False, out = None):
         '''
         Create np.array((8,L,W)) of quantity a in each of the neighbors to a cell
+
+        If out is given, the neighbor values are written into it in place
         '''
 
-        self.array = array
         a_shape = array.shape
 
-        self.fix_edges = fix_edges
-        self.normalize = normalize
+        if out is None:
+            wgt_array = np.zeros((8,a_shape[0],a_shape[1]))
+        else:
+            wgt_array = out
+
+            if not fix_edges:
+                # clear the edges left over from the last use of out
+                wgt_array[[0,1,7],:,-1] = 0
+                wgt_array[[1,2,3],0,:] = 0
+                wgt_array[[3,4,5],:,0] = 0
+                wgt_array[[5,6,7],-1,:] = 0
 
-        wgt_array = np.zeros((8,a_shape[0],a_shape[1]))
         nums = range(8)
 
-        wgt_array[nums[0],:,:-1] = self.array[:,1:] # E
-        wgt_array[nums[1],1:,:-1] = self.array[:-1,1:] # NE
-        wgt_array[nums[2],1:,:] = self.array[:-1,:] # N
-        wgt_array[nums[3],1:,1:] = self.array[:-1,:-1] # NW
-        wgt_array[nums[4],:,1:] = self.array[:,:-1] # W
-        wgt_array[nums[5],:-1,1:] = self.array[1:,:-1] # SW
-        wgt_array[nums[6],:-1,:] = self.array[1:,:] # S
-        wgt_array[nums[7],:-1,:-1] = self.array[1:,1:] # SE
+        for k, (nh, cell) in enumerate(self._nh_slices):
+            wgt_array[nums[k]][cell] = array[nh]
 
-        if self.fix_edges:
+        if fix_edges:
             wgt_array[nums[0],:,-1] = wgt_array[nums[0],:,-2]
             wgt_array[nums[1],:,-1] = wgt_array[nums[1],:,-2]
             wgt_array[nums[7],:,-1] = wgt_array[nums[7],:,-2]
@@ -125,28 +333,52 @@ class Tools(object):
             wgt_array[nums[6],-1,:] = wgt_array[nums[6],-2,:]
             wgt_array[nums[7],-1,:] = wgt_array[nums[7],-2,:]
 
-        if self.normalize:
-            a_sum = np.sum(wgt_array, axis=0)
-            wgt_array[:,a_sum!=0] = wgt_array[:,a_sum!=0] / a_sum[a_sum!=0]
+        if normalize:
+            self.normalize_weight_array(wgt_array, nonzero = True)
 
         return wgt_array
 
 
 
-    def get_wet_mask_nh(self):
+    def normalize_weight_array(self, wgt_array, nonzero = False):
+        '''
+        Divide np.array((8,L,W)) in place by its sum over the 8 neighbors
+
+        Cells where the sum is not positive (not zero if nonzero) are left as they are
+        '''
+
+        wgt_sum = np.sum(wgt_array, axis=0, out=self.get_buffer('sum', wgt_array.shape[1:]))
+
+        if nonzero:
+            mask = wgt_sum != 0
+        else:
+            mask = wgt_sum > 0
+
+        np.divide(wgt_array, wgt_sum, out=wgt_array, where=mask)
+
+        return wgt_sum
+
+
+
+    def get_wet_mask_nh(self, window = None):
         '''
         Get np.array((8,L,W)) for each neighbor around a cell
         with 1 if te neighbor is wet and 0 if dry
+
+        If window is given, only for the cells of window (see expand_window)
         '''
 
-        wet_mask = (self.depth > self.dry_depth) * 1
-        wet_mask_nh = self.build_weight_array(wet_mask, fix_edges = True)
+        depth = self.depth[self.full_window(window)]
+
+        wet_mask = (depth > self.dry_depth) * 1
+        wet_mask_nh = self.build_weight_array(wet_mask, fix_edges = True,
+                                              out = self.get_buffer('wet_mask_nh', (8,) + depth.shape))
 
         return wet_mask_nh
 
 
 
-    def get_wgt_sfc(self, wet_mask_nh):
+    def get_wgt_sfc(self, wet_mask_nh, window = None):
         '''
         Get np.array((8,L,W)) (H - H_neighbor)/dist
         for each neighbor around a cell
@@ -154,21 +386,24 @@ class Tools(object):
         Takes an narray of the same size with 1 if wet and 0 if not
         '''
 
-        wgt_sfc = self.build_weight_array(self.stage, fix_edges = True)
+        stage = self.stage[self.full_window(window)]
+
+        wgt_sfc = self.build_weight_array(stage, fix_edges = True,
+                                          out = self.get_buffer('wgt_sfc', wet_mask_nh.shape))
 
-        wgt_sfc = (self.stage - wgt_sfc) / np.array(self.dxn_dist)[:, np.newaxis, np.newaxis]
+        np.subtract(stage, wgt_sfc, out=wgt_sfc)
+        wgt_sfc /= self.dxn_dist_nh
 
-        wgt_sfc = wgt_sfc * wet_mask_nh
-        wgt_sfc[wgt_sfc<0] = 0
+        wgt_sfc *= wet_mask_nh
+        np.maximum(wgt_sfc, 0, out=wgt_sfc)
 
-        wgt_sfc_sum = np.sum(wgt_sfc,axis=0)
-        wgt_sfc[:,wgt_sfc_sum>0] = wgt_sfc[:,wgt_sfc_sum>0] / wgt_sfc_sum[wgt_sfc_sum>0]
+        self.normalize_weight_array(wgt_sfc)
 
         return wgt_sfc
 
 
 
-    def get_wgt_int(self, wet_mask_nh):
+    def get_wgt_int(self, wet_mask_nh, window = None):
         '''
         Get np.array((8,L,W)) (qx*dxn_ivec + qy*dxn_jvec)/dist
         for each neighbor around a cell
@@ -176,23 +411,29 @@ class Tools(object):
         Takes an narray of the same size with 1 if wet and 0 if not
         '''
 
-        wgt_int = (self.qx * np.array(self.dxn_ivec)[:,np.newaxis,np.newaxis] + \
-            self.qy * np.array(self.dxn_jvec)[:,np.newaxis,np.newaxis]) / \
-            np.array(self.dxn_dist)[:,np.newaxis,np.newaxis]
+        window = self.full_window(window)
 
-        wgt_int[1:4,0,:] = 0
+        wgt_int = self.get_buffer('wgt_int', wet_mask_nh.shape)
+        wgt_tmp = self.get_buffer('tmp', wet_mask_nh.shape)
 
-        wgt_int = wgt_int * wet_mask_nh
-        wgt_int[wgt_int<0] = 0
-        wgt_int_sum = np.sum(wgt_int, axis=0)
+        np.multiply(self.qx[window], self.dxn_ivec_nh, out=wgt_int)
+        np.multiply(self.qy[window], self.dxn_jvec_nh, out=wgt_tmp)
+        wgt_int += wgt_tmp
+        wgt_int /= self.dxn_dist_nh
 
-        wgt_int[:,wgt_int_sum>0] = wgt_int[:,wgt_int_sum>0]/wgt_int_sum[wgt_int_sum>0]
+        if window[0].start == 0:
+            wgt_int[1:4,0,:] = 0
+
+        wgt_int *= wet_mask_nh
+        np.maximum(wgt_int, 0, out=wgt_int)
+
+        self.normalize_weight_array(wgt_int)
 
         return wgt_int
 
 
 
-    def get_wgt(self):
+    def get_wgt(self, window = None):
         '''
         Get np.array((8,L,W)) of the probabilities of flow
         between a cell and each of its neighbors
@@ -201,37 +442,41 @@ class Tools(object):
         be split equally among all wet neighbors
         '''
 
-        wet_mask_nh = self.get_wet_mask_nh()
-        wgt_sfc = self.get_wgt_sfc(wet_mask_nh)
-        wgt_int = self.get_wgt_int(wet_mask_nh)
+        window = self.full_window(window)
+        depth = self.depth[window]
 
+        wet_mask_nh = self.get_wet_mask_nh(window)
+        wgt_sfc = self.get_wgt_sfc(wet_mask_nh, window)
+        wgt_int = self.get_wgt_int(wet_mask_nh, window)
 
-        weight = self.gamma * wgt_sfc + (1-self.gamma) * wgt_int
+        # weight = gamma * wgt_sfc + (1-gamma) * wgt_int
+        weight = wgt_sfc
+        weight *= self.gamma
+        wgt_int *= (1-self.gamma)
+        weight += wgt_int
 
-        wgt = self.build_weight_array(self.depth, fix_edges = True)
-        wgt = wgt**self.theta_water * weight
+        wgt = self.build_weight_array(depth, fix_edges = True,
+                                      out = self.get_buffer('wgt', wet_mask_nh.shape))
+        wgt **= self.theta_water
+        wgt *= weight
 
-        wet_mask = 1*(self.depth > self.dry_depth)
-        wgt = wgt * wet_mask
-        wgt[wgt<0] = 0
-        wgt_sum = np.sum(wgt,axis=0)
-        wgt[:,wgt_sum>0] = wgt[:,wgt_sum>0] / wgt_sum[wgt_sum>0]
+        wet_mask = 1*(depth > self.dry_depth)
+        wgt *= wet_mask
+        np.maximum(wgt, 0, out=wgt)
+        wgt_sum = self.normalize_weight_array(wgt)
 
         # give wet cells with zero wgt to all wet neighbors equal probs for each of them
         # wet cells with zero probabilities to all neighbors
-        wet_mask = 1*(self.depth > self.dry_depth)
-
-        wet_cells = np.where((wgt_sum + (wet_mask-1)) == 0)
-
-        wet = [(wet_cells[0][i],wet_cells[1][i]) for i in range(len(wet_cells[0]))]
+        wet_cells = (wgt_sum + (wet_mask-1)) == 0
 
         # new weights to those cells - partitioned equally among the wet neighbors
-        new_vals = [wet_mask_nh[:,i[0],i[1]]/sum(wet_mask_nh[:,i[0],i[1]]) for i in wet]
+        wet_mask_nh_sum = np.sum(wet_mask_nh, axis=0)
+        wet_cells &= wet_mask_nh_sum > 0
 
-        for i in range(len(new_vals)):
-            wgt[:,wet[i][0],wet[i][1]] = new_vals[i]
+        np.divide(wet_mask_nh, wet_mask_nh_sum, out=wgt, where=wet_cells)
 
-        wgt[1:4,0,:] = 0
+        if window[0].start == 0:
+            wgt[1:4,0,:] = 0
 
         return wgt
 
@@ -239,25 +484,91 @@ class Tools(object):
 
     def get_sed_weight(self):
         '''
-        Get np.array((8,L,W)) of probability field of routing to neighbors
+        Get np.array((L*W,8)) of probability field of routing to neighbors
         for sediment parcels
+
+        Only the cells in the active window are recomputed
         '''
 
-        wet_mask_nh = self.get_wet_mask_nh()
+        window, inner = self.expand_window(self.active_window, 1)
+
+        wet_mask_nh = self.get_wet_mask_nh(window)
+
+        weight = self.get_wgt_int(wet_mask_nh, window)
+        weight *= self.depth[window]**self.theta_sand
+        weight *= wet_mask_nh
+
+        np.maximum(weight, 0, out=weight)
+        self.normalize_weight_array(weight)
+
+        weight_f = self.get_buffer('sed_weight_flat', (self.L*self.W,8))
+        self.set_flat_weights(weight_f, weight, self.active_window, inner)
 
-        weight = self.get_wgt_int(wet_mask_nh) * \
-            self.depth**self.theta_sand * wet_mask_nh
+        return weight_f
+
+
+
+    def set_flat_weights(self, weight_f, weight, window, inner):
+        '''
+        Copy the weights np.array((8,l,w)) of the cells inner of weight
+        into the rows of np.array((L*W,8)) weight_f of the cells window
+        '''
+
+        weight_f.reshape(self.L, self.W, 8)[window] = \
+            np.rollaxis(weight[(slice(None),) + inner], 0, 3)
+
+
+
+    def update_sed_weight(self, weight_f, changed):
+        '''
+        Update the sediment routing weights in place for the cells with
+        flat indices changed and their neighbors, after their depth changed
+        '''
+
+        changed = np.unique(changed)
+        rows, cols = np.unravel_index(changed, (self.L, self.W))
+
+        cells = np.unique(np.append(self.neighbor_indices(rows, cols), changed))
+        rows, cols = np.unravel_index(cells, (self.L, self.W))
+
+        dxn_ivec = np.array(self.dxn_ivec)[:,np.newaxis]
+        dxn_jvec = np.array(self.dxn_jvec)[:,np.newaxis]
+        dxn_dist = np.array(self.dxn_dist)[:,np.newaxis]
+
+        # same steps as get_wet_mask_nh, get_wgt_int and get_sed_weight
+        # on an np.array((8,n)) for the n cells that need updating
+        wet_mask_nh = (self.depth.flat[self.neighbor_indices(rows, cols)] > self.dry_depth) * 1
+
+        wgt_int = (self.qx.flat[cells] * dxn_ivec + self.qy.flat[cells] * dxn_jvec) / dxn_dist
+        wgt_int[1:4,rows==0] = 0
+
+        wgt_int = wgt_int * wet_mask_nh
+        wgt_int[wgt_int<0] = 0
+        wgt_int_sum = np.sum(wgt_int, axis=0)
+        wgt_int[:,wgt_int_sum>0] = wgt_int[:,wgt_int_sum>0]/wgt_int_sum[wgt_int_sum>0]
+
+        weight = wgt_int * self.depth.flat[cells]**self.theta_sand * wet_mask_nh
 
         weight[weight<0] = 0.
         weight_sum = np.sum(weight,axis=0)
         weight[:,weight_sum>0] = weight[:,weight_sum>0]/weight_sum[weight_sum>0]
 
-        weight_f = np.zeros((self.L*self.W,8))
+        weight_f[cells,:] = weight.T
 
-        for i in range(8):
-            weight_f[:,i] = weight[i,:,:].flatten()
 
-        return weight_f
+
+    def neighbor_indices(self, rows, cols):
+        '''
+        Get np.array((8,n)) of the flat indices of the neighbors of n cells
+
+        Neighbors outside the domain are replaced by the closest cell
+        inside the domain, as done by build_weight_array with fix_edges
+        '''
+
+        nh_rows = np.clip(rows - np.array(self.dxn_jwalk)[:,np.newaxis], 0, self.L-1)
+        nh_cols = np.clip(cols + np.array(self.dxn_iwalk)[:,np.newaxis], 0, self.W-1)
+
+        return nh_rows * self.W + nh_cols
 
 
 
@@ -267,7 +578,7 @@ class Tools(object):
 
     def smoothing_filter(self, stageTemp):
         '''
-        Smooth water surface
+        Smooth water surface in the active window
 
         If any of the cells in a 9-cell window are wet, apply this filter
 
@@ -275,17 +586,23 @@ class Tools(object):
         stageT : smoothed water surface
         '''
 
-        stageT = stageTemp.copy()
-        wet_mask = self.depth > self.dry_depth
+        window = self.active_window
+        grown, inner = self.expand_window(window, self.Nsmooth)
+
+        stageT = stageTemp[grown].copy()
+        wet_mask = self.depth[grown] > self.dry_depth
 
         for t in range(self.Nsmooth):
 
-            local_mean = ndimage.uniform_filter(stageT)
+            local_mean = uniform_filter(stageT)
 
             stageT[wet_mask] = self.Csmooth * stageT[wet_mask] + \
                 (1-self.Csmooth) * local_mean[wet_mask]
 
-        returnval = (1-self.omega_sfc) * self.stage + self.omega_sfc * stageT
+        # outside of the active window the stage is left as it is
+        returnval = self.stage.copy()
+        returnval[window] = (1-self.omega_sfc) * self.stage[window] + \
+            self.omega_sfc * stageT[inner]
 
         return returnval
 
@@ -310,41 +627,53 @@ class Tools(object):
         # indices of dry cells with wet neighbors
         shore_ind = np.where(wet_mask_nh_sum > 0)
 
-        stage_nhs = self.build_weight_array(self.stage)
-        eta_shore = self.eta[shore_ind]
+        stage_nhs = self.build_weight_array(self.stage, out = self.get_buffer('stage_nhs'))
 
-        for i in range(len(shore_ind[0])):
+        # pretends dry neighbor cells have stage zero so they cannot be > eta
+        stage_nhs *= wet_mask_nh
+        stage_nh_max = np.max(stage_nhs[:,shore_ind[0],shore_ind[1]], axis=0)
 
-            # pretends dry neighbor cells have stage zero so they cannot be > eta_shore[i]
-            stage_nh = wet_mask_nh[:,shore_ind[0][i],shore_ind[1][i]] * \
-                stage_nhs[:,shore_ind[0][i],shore_ind[1][i]]
-
-            if (stage_nh > eta_shore[i]).any():
-                self.stage[shore_ind[0][i],shore_ind[1][i]] = max(stage_nh)
+        # flood the shore cells where any wet neighbor is higher than the bed
+        flood = stage_nh_max > self.eta[shore_ind]
+        self.stage[shore_ind[0][flood],shore_ind[1][flood]] = stage_nh_max[flood]
 
 
 
     def topo_diffusion(self):
         '''
-        Diffuse topography after routing all coarse sediment parcels
+        Diffuse topography in the active window after routing all sediment
+        parcels, with the conductance set by the flux of sand (qs_sand)
         '''
 
-        wgt_cell_type = self.build_weight_array(self.cell_type > -2)
-        wgt_qs = self.build_weight_array(self.qs) + self.qs
-        wet_mask_nh = self.get_wet_mask_nh()
+        self.update_active_window()
+        window = self.active_window
+
+        qs = self.qs_sand[window]
+        eta = self.eta[window]
+
+        conductance = self.build_weight_array(qs, out = self.get_buffer('wgt_qs', (8,) + qs.shape))
+        conductance += qs
+        conductance *= self.get_wet_mask_nh(window)
 
         multiplier = self.dt/self.N_crossdiff * self.alpha * 0.5 / self.dx**2
+        conductance *= multiplier
+
+        conductance_sum = np.sum(conductance, axis=0, out=self.get_buffer('sum', eta.shape))
+
+        crossflux = self.get_buffer('crossflux', eta.shape)
+        flux_nb = self.get_buffer('flux_nb', eta.shape)
 
         for n in range(self.N_crossdiff):
 
-            wgt_eta = self.build_weight_array(self.eta) - self.eta
+            np.multiply(conductance_sum, eta, out=crossflux)
+            np.negative(crossflux, out=crossflux)
 
-            crossflux_nb = multiplier * wgt_qs * wgt_eta
+            for k, (nh, cell) in enumerate(self._nh_slices):
 
-            crossflux_nb = crossflux_nb * wet_mask_nh
+                np.multiply(conductance[k][cell], eta[nh], out=flux_nb[cell])
+                crossflux[cell] += flux_nb[cell]
 
-            crossflux = np.sum(crossflux_nb, axis=0)
-            self.eta = self.eta + crossflux
+            eta += crossflux
 
 
 
@@ -363,7 +692,7 @@ class Tools(object):
         self.qxn *= qwn_div
         self.qyn *= qwn_div
 
-        if timestep > 0:
+        if self._spun_up:
 
             omega = self.omega_flow_iter
             if iteration == 0: omega = self.omega_flow
@@ -382,18 +711,42 @@ class Tools(object):
 
 
 
+    def flow_change(self, qwn_old):
+        '''
+        Relative change of the routed discharge qwn since the previous
+        water iteration (qwn_old), without the sampling noise of the parcels
+        '''
+
+        # the number of parcels through a cell varies by about its square
+        # root, which adds (qwn + qwn_old) * Qp_water/dx to the squared change
+        change = np.sum((self.qwn - qwn_old)**2, dtype=np.float64)
+        noise = np.sum(self.qwn + qwn_old, dtype=np.float64) * self.Qp_water/self.dx
+
+        return sqrt(max(change - noise, 0) / max(np.sum(qwn_old**2, dtype=np.float64), 1e-12))
+
+
+
     def update_velocity_field(self):
         '''
         Update the flow velocity field after one water iteration
+
+        There is no flow outside of the active window, so only the
+        velocities in the window are updated
         '''
 
-        mask = (self.depth > self.dry_depth) * (self.qw > 0)
-        self.uw[mask] = np.minimum(self.u_max, self.qw[mask] / self.depth[mask])
-        self.uw[~mask] = 0
-        self.ux[mask]= self.uw[mask] * self.qx[mask] / self.qw[mask]
-        self.ux[~mask] = 0
-        self.uy[mask]= self.uw[mask] * self.qy[mask] / self.qw[mask]
-        self.uy[~mask] = 0
+        window = self.active_window
+
+        depth = self.depth[window]; qw = self.qw[window]
+        qx = self.qx[window]; qy = self.qy[window]
+        uw = self.uw[window]; ux = self.ux[window]; uy = self.uy[window]
+
+        mask = (depth > self.dry_depth) * (qw > 0)
+        uw[mask] = np.minimum(self.u_max, qw[mask] / depth[mask])
+        uw[~mask] = 0
+        ux[mask]= uw[mask] * qx[mask] / qw[mask]
+        ux[~mask] = 0
+        uy[mask]= uw[mask] * qy[mask] / qw[mask]
+        uy[~mask] = 0
 
 
 
@@ -403,14 +756,13 @@ class Tools(object):
 
     def init_water_iteration(self):
 
-        wgt = self.get_wgt()
+        window, inner = self.expand_window(self.active_window, 1)
+        wgt = self.get_wgt(window)
 
-        for i in range(8):
-            self.wgt_flat[:,i] = wgt[i,:,:].flatten()
+        self.set_flat_weights(self.wgt_flat, wgt, self.active_window, inner)
 
         self.qxn[:] = 0; self.qyn[:] = 0; self.qwn[:] = 0
 
-        self.indices = np.zeros((self.Np_water, self.itmax/2), dtype = np.int)
         self.path_number = np.array(range(self.Np_water))
         self.save_paths = []
 
@@ -418,76 +770,177 @@ class Tools(object):
 
     def run_water_iteration(self):
         '''
-        Route all parcels of water in one iteration
+        Route all parcels of water in one iteration, in n_workers chunks
+        on a pool of threads (the results do not depend on n_workers)
+        '''
+
+        stream = self.rng.next_stream()
+
+        n_chunks = max(1, min(self.n_workers, len(self.path_number)))
+        chunks = np.array_split(self.path_number, n_chunks)
+
+        if n_chunks > 1:
+            routed = self.worker_pool().map(
+                lambda parcels: self.route_water_parcels(parcels, stream), chunks)
+        else:
+            routed = [self.route_water_parcels(chunks[0], stream)]
+
+        start_count = sum(r[0] for r in routed)
+        step_count = sum(r[1] for r in routed)
+        ind_count = sum(r[2] for r in routed)
+
+        # each jump adds its walk vector to the cells at both of its ends
+        qxn = start_count + step_count[0] + sqrt(0.5) * step_count[2]
+        qyn = step_count[1] + sqrt(0.5) * step_count[3]
+
+        self.qxn += qxn.reshape(self.qxn.shape)
+        self.qyn += qyn.reshape(self.qyn.shape)
+
+        self.path_store = PathStore.concatenate([r[3] for r in routed], self.Np_water)
+
+        # in the order they reached the edge, as if routed together
+        exits = sorted([e for r in routed for e in r[4]], key = lambda e: e[0])
+        self.save_paths.extend([parcels for it, parcels in exits])
+
+        qwn_sum = ind_count * self.Qp_water/self.dx
+
+        self.qwn += qwn_sum.reshape(self.qwn.shape)
+
+        self.update_active_window()
+
+
+
+    def route_water_parcels(self, path_number, stream):
+        '''
+        Route the water parcels path_number until they leave the domain,
+        loop or reach itmax jumps. Returns the counts of the flat cells,
+        the PathStore of the paths and the (jump, parcels) that left
         '''
 
-        these_indices = map(lambda x: self.random_pick_list(self.inlet), range(self.Np_water))
-        these_indices = map(self.flatten_indices, these_indices)
+        n_cells = self.L*self.W
+
+        path_store = PathStore(self.Np_water, capacity = 8*len(path_number))
+        save_paths = []
+
+        # the inlet cells are in row 0, so their flat index is the column
+        these_indices = stream.choice(self.inlet, path_number, 0)
+        start_count = np.bincount(these_indices, minlength=n_cells)
+
+        path_store.append(path_number, these_indices)
+
+        steps = CellCounts(n_cells, self.walk_steps)
 
-        self.indices[:,0] = these_indices
-        self.qxn.flat[these_indices] += 1
+        if self.outlet_paths_only:
+            visits = CellCounts(n_cells)
+            visits.add(these_indices)
 
-        water_continue = True
+        visited = self.init_visited(path_number, these_indices)
+
+        water_continue = len(path_number) > 0
         it = 0
 
         while water_continue:
 
-            ngh = map(self.random_pick, self.wgt_flat[these_indices])
-            new_indices = these_indices + self.walk_flat[ngh]
-            new_ind_type = self.cell_type.flat[new_indices]
+            ngh = self.random_pick_batch(self.wgt_flat[these_indices],
+                stream.uniform(path_number, it+1))
+            new_indices = self.nbr_flat[these_indices, ngh]
+            new_ind_type = self.nbr_type[these_indices, ngh]
 
             # save the path numbers of the ones that reached the edge
-            if self.path_number[new_ind_type == -1].any():
-                self.save_paths.append( list(self.path_number[new_ind_type == -1]) )
-
-            walk_vals = self.walk[ngh]
-            self.qxn.flat[these_indices] += walk_vals[:,0]
-            self.qyn.flat[these_indices] += walk_vals[:,1]
+            if (new_ind_type == -1).any():
+                save_paths.append( (it, path_number[new_ind_type == -1]) )
 
-            walk_vals = self.walk[list( np.array(ngh)[new_ind_type >= -1] )]
             n_these_indices = new_indices[new_ind_type >= -1]
-            n_path_number = self.path_number[new_ind_type >= -1]
-            for i in range(len(n_these_indices)):
-                self.qxn.flat[n_these_indices[i]] += walk_vals[i,0]
-                self.qyn.flat[n_these_indices[i]] += walk_vals[i,1]
+            n_path_number = path_number[new_ind_type >= -1]
+
+            steps.add(these_indices, ngh)
+            steps.add(n_these_indices, ngh[new_ind_type >= -1])
 
             it += 1
-            self.indices[n_path_number,it] = n_these_indices
+            path_store.append(n_path_number, n_these_indices)
+
+            if self.outlet_paths_only:
+                visits.add(n_these_indices)
+                path_store.discard(path_number[new_ind_type == -2])
 
             these_indices = new_indices[new_ind_type >= 0]
-            self.path_number = self.path_number[new_ind_type >= 0]
+            path_number = path_number[new_ind_type >= 0]
 
             # check for looping
-            if len(self.path_number)>0:
-                keeper = np.ones((len(these_indices),), dtype=np.int)
-                for i in range(len(these_indices)):
-
-                    if np.in1d(self.indices[self.path_number[i],:it], these_indices[i]).any():
-                        keeper[i] = 0
+            if len(path_number)>0:
+                keeper = self.check_looping(visited, path_number, these_indices)
 
-                    if these_indices[i]<0:
-                        keeper[i] = 0
+                if self.outlet_paths_only:
+                    path_store.discard(path_number[~keeper])
 
-                if np.min(keeper)==0:
-
-                    these_indices = these_indices[keeper == 1]
-                    self.path_number = self.path_number[keeper == 1]
+                these_indices = these_indices[keeper]
+                path_number = path_number[keeper]
 
             if it == self.itmax-1 or len(these_indices)==0:
                 water_continue = False
 
-        # update qwn by counting the indices
-        all_indices = self.indices.flatten()
-        all_indices.sort()
-        loc = np.where(all_indices>0)[0][0]
-        ind_index_all = all_indices[loc:]
+        # count the visits to each cell
+        if self.outlet_paths_only:
+            ind_count = visits.totals()
+        else:
+            ind_count = path_store.count_cells(n_cells)
+
+        return start_count, steps.totals(), ind_count, path_store, save_paths
+
+
+
+    def worker_pool(self):
+        '''
+        Get the pool of n_workers threads, starting it if needed
+        '''
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.n_workers)
+
+        return self._pool
 
-        ind_count = np.bincount(ind_index_all)
-        ind_index = range(max(ind_index_all)+1)
 
-        qwn_sum = ind_count[ind_index] * self.Qp_water/self.dx
 
-        self.qwn.flat[ind_index] += qwn_sum
+    def close_pool(self):
+        '''
+        Stop the threads of the worker pool
+        '''
+
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+
+    def init_visited(self, path_number, these_indices):
+        '''
+        Start the record of visited cells used to detect looping parcels
+
+        Each (parcel, cell) pair is stored as a single int64 key in
+        VisitedCells, so all active parcels are checked together
+        '''
+
+        keys = np.asarray(path_number, dtype=np.int64) * self.L*self.W + these_indices
+
+        return VisitedCells(keys)
+
+
+
+    def check_looping(self, visited, path_number, these_indices):
+        '''
+        Find parcels that moved into a cell they had already visited
+
+        Return a boolean array that is True for the parcels that keep walking
+        and add the new cells of those parcels to visited
+        '''
+
+        keys = np.asarray(path_number, dtype=np.int64) * self.L*self.W + these_indices
+
+        keeper = these_indices >= 0
+        keeper[keeper] = visited.add(keys[keeper])
+
+        return keeper
 
 
 
@@ -510,79 +963,68 @@ class Tools(object):
         '''
         Calculate the water surface profiles after routing flow parcels
         Update water surface array
-        '''
 
-        paths_for_profile = [i for j in self.save_paths for i in j]
-
-        assert len(paths_for_profile) == len(set(paths_for_profile)), "save_paths has repeats!"
+        The good paths are stored end to end in one array (cells), with
+        path_len cells in each path, so all profiles are computed together
+        '''
 
-        # get all the unique indices in good paths
-        unique_cells = list(set([j for i in paths_for_profile for j in list(set(self.indices[i]))]))
-        try:
-            unique_cells.remove(0)
-        except:
-            pass
+        paths_for_profile = np.concatenate([np.zeros((0,), dtype=np.int)] + self.save_paths)
 
-        unique_cells.sort()
+        assert len(paths_for_profile) == len(np.unique(paths_for_profile)), "save_paths has repeats!"
 
-        # extract the values needed for the paths -- no need to do this for the entire space
-        uw_unique = self.uw.flat[unique_cells]
-        depth_unique = self.depth.flat[unique_cells]
-        ux_unique = self.ux.flat[unique_cells]
-        uy_unique = self.uy.flat[unique_cells]
+        cells, path_len = self.path_store.paths(paths_for_profile)
 
-        profile_mask = np.add(uw_unique > 0.5*self.u0, depth_unique < 0.1*self.h0)
+        path_id = np.repeat(np.arange(len(path_len)), path_len)
+        path_start = np.cumsum(path_len) - path_len
+        pos = np.arange(len(cells)) - path_start[path_id]
 
-        all_unique = zip(profile_mask,uw_unique,ux_unique,uy_unique)
+        # find the last True in each path
+        prf = (self.uw.flat[cells] > 0.5*self.u0) | (self.depth.flat[cells] < 0.1*self.h0)
 
-        sfc_array = np.zeros((len(unique_cells),2))
+        last_True = np.zeros(len(path_len), dtype=np.int)
+        np.maximum.at(last_True, path_id[prf], pos[prf])
 
-        # make dictionaries to use as lookup tables
-        lookup = {}
-        self.sfc_change = {}
+        # the profile of each path runs up to (not including) its last True
+        # paths without a True, or with it at the start, get no profile
+        sub_path = pos < last_True[path_id]
 
-        for i in range(len(unique_cells)):
-            lookup[unique_cells[i]] = all_unique[i]
-            self.sfc_change[unique_cells[i]] = sfc_array[i]
+        cells = cells[sub_path]
+        path_id = path_id[sub_path]
+        pos = pos[sub_path]
 
-        # process each profile
-        for i in paths_for_profile:
+        # dH from each cell to the next one in the same path
+        # and zero at the end of each path
+        has_next = pos < last_True[path_id] - 1
+        step = np.nonzero(has_next)[0]
 
-            path = self.indices[i]
-            path = path[np.where(path>0)]
+        rows, cols = np.unravel_index(cells, self.eta.shape)
 
-            prf = [lookup[i][0] for i in path]
+        ux_ = self.ux.flat[cells[step]]
+        uy_ = self.uy.flat[cells[step]]
+        uw_ = self.uw.flat[cells[step]]
 
-            # find the last True
-            try:
-                last_True = (len(prf) - 1) - prf[::-1].index(True)
-                sub_path = path[:last_True]
+        dH_ = self.S0 * (ux_ * (rows[step+1] - rows[step]) + \
+            uy_ * (cols[step+1] - cols[step])) * self.dx
 
-                sub_path_unravel = np.unravel_index(sub_path, self.eta.shape)
+        dH = np.zeros(len(cells))
+        dH[step] = np.divide(dH_, uw_, out=np.zeros_like(dH_), where=uw_>0)
 
-                path_diff = np.diff(sub_path_unravel)
-                ux_ = [lookup[i][2] for i in sub_path[:-1]]
-                uy_ = [lookup[i][3] for i in sub_path[:-1]]
-                uw_ = [lookup[i][1] for i in sub_path[:-1]]
+        # newH is the sum of dH from each cell to the end of its path:
+        # the reverse cumulative sum of the whole array minus its value at the path end
+        dH_cumsum = np.cumsum(dH[::-1])[::-1]
 
-                dH = self.S0 * (ux_ * path_diff[0] + uy_ * path_diff[1]) * self.dx
-                dH = [dH[i] / uw_[i] if uw_[i]>0 else 0 for i in range(len(dH))]
-                dH.append(0)
+        path_end = np.zeros(len(path_len), dtype=np.int)
+        path_end[path_id[~has_next]] = np.nonzero(~has_next)[0]
 
-                newH = np.zeros(len(sub_path))
-                for i in range(-2,-len(sub_path)-1,-1):
-                    newH[i] = newH[i+1] + dH[i]
+        newH = dH_cumsum - dH_cumsum[path_end[path_id]]
 
-                for i in range(len(sub_path)):
-                    self.sfc_change[sub_path[i]] += [newH[i],1]
-            except:
-                pass
+        sfc_sum = np.bincount(cells, weights=newH, minlength=self.L*self.W)
+        sfc_count = np.bincount(cells, minlength=self.L*self.W)
 
         stageTemp = self.eta + self.depth
 
-        for k, v in self.sfc_change.iteritems():
-            if np.max(v) > 0:
-                stageTemp.flat[k] = v[0]/v[1]
+        sfc_mask = sfc_count > 0
+        stageTemp.flat[sfc_mask] = sfc_sum[sfc_mask] / sfc_count[sfc_mask]
 
         self.stage = self.smoothing_filter(stageTemp)
 
@@ -598,219 +1040,208 @@ class Tools(object):
         '''
 
         self.qs[:] = 0
+        self.qs_sand[:] = 0
         self.Vp_dep_sand[:] = 0
         self.Vp_dep_mud[:] = 0
 
 
 
-    def one_fine_timestep(self):
+    def one_sed_timestep(self):
         '''
-        Route all parcels of fine sediment
+        Route all parcels of coarse (sand) and fine (mud) sediment together
+
+        The first num_coarse parcels are sand and the rest are mud
         '''
 
+        self.num_coarse = int(round(self.Np_sed*self.f_bedload))
         self.num_fine = int(self.Np_sed - self.num_coarse)
 
-        if self.num_fine>0:
+        if self.Np_sed>0:
+
+            path_number = np.array(range(self.Np_sed))
+
+            stream = self.rng.next_stream()
 
-            these_indices = map(lambda x: self.random_pick_list(self.inlet),range(self.num_fine))
-            these_indices = map(self.flatten_indices,these_indices)
+            # the inlet cells are in row 0, so their flat index is the column
+            these_indices = stream.choice(self.inlet, path_number, 0)
+            visited = self.init_visited(path_number, these_indices)
 
-            self.indices = np.zeros((self.num_fine,self.itmax), dtype=np.int)
-            self.indices[:,0] = these_indices
+            sed_class = np.zeros((self.Np_sed,), dtype=np.int)
+            sed_class[self.num_coarse:] = 1
 
-            path_number = np.array(range(self.num_fine))
             self.Vp_res = np.zeros((self.Np_sed,)) + self.Vp_sed
-            self.qs.flat[these_indices] += self.Vp_res[path_number]/2/self.dt/self.dx
+            self.add_sed_flux(these_indices, path_number, sed_class)
+
+            weight = self.get_sed_weight()
 
             sed_continue = True
             it = 0
 
             while sed_continue:
 
-                weight = self.get_sed_weight()
-
-                ngh = map(self.random_pick, weight[these_indices])
-                new_indices = these_indices + self.walk_flat[ngh]
-                new_ind_type = self.cell_type.flat[new_indices]
+                changed = []
 
-                self.qs.flat[these_indices] += self.Vp_res[path_number]/2/self.dt/self.dx
-                self.qs.flat[new_indices] += self.Vp_res[path_number]/2/self.dt/self.dx
+                ngh = self.random_pick_batch(weight[these_indices],
+                    stream.uniform(path_number, it+1))
+                new_indices = self.nbr_flat[these_indices, ngh]
+                new_ind_type = self.nbr_type[these_indices, ngh]
 
+                self.add_sed_flux(these_indices, path_number, sed_class)
+                self.add_sed_flux(new_indices, path_number, sed_class)
 
                 these_indices = new_indices[new_ind_type >= 0]
                 path_number = path_number[new_ind_type >= 0]
 
                 if len(path_number)>0:
                     # check for looping
-                    keeper = np.ones((len(these_indices),), dtype=np.int)
-                    for i in range(len(these_indices)):
-                        if np.in1d(self.indices[path_number[i],:], these_indices[i]).any():
-                            keeper[i] = 0
-                        if these_indices[i]<0:
-                            keeper[i] = 0
-                    if np.min(keeper)==0:
-                        these_indices = these_indices[keeper == 1]
-                        path_number = path_number[keeper == 1]
-
-                # save to the master indices
-                it += 1
-                self.indices[path_number,it] = these_indices
-
-
-                if (self.uw.flat[these_indices] < self.U_dep_mud).any():
+                    keeper = self.check_looping(visited, path_number, these_indices)
+                    these_indices = these_indices[keeper]
+                    path_number = path_number[keeper]
 
-                    update_ind = these_indices[self.uw.flat[these_indices] < self.U_dep_mud]
-                    update_path = path_number[self.uw.flat[these_indices] < self.U_dep_mud]
-                    Vp_res_ = self.Vp_res[update_path]
+                it += 1
 
-                    Vp_res_ = self.sed_lag * Vp_res_ * (self.U_dep_mud**self.beta - self.uw.flat[update_ind]**self.beta) / (self.U_dep_mud**self.beta)
+                # sand: deposit above the transport capacity, erode below it
+                sand = sed_class[path_number] == 0
+                sand_ind = these_indices[sand]
+                sand_path = path_number[sand]
 
-                    self.Vp_dep = (self.stage.flat[update_ind] - self.eta.flat[update_ind])/4 * self.dx**2
-                    self.Vp_dep = np.array([min((Vp_res_[i],self.Vp_dep[i])) for i in range(len(self.Vp_dep))])
-                    self.Vp_dep_mud.flat[update_ind] += self.Vp_dep
+                qs_cap = self.qs0 * self.f_bedload/self.u0**self.beta * self.uw.flat[sand_ind]**self.beta
 
-                    self.Vp_res[update_path] -= self.Vp_dep
+                dep = self.qs_sand.flat[sand_ind] > qs_cap
+                self.update_bed(self.deposit_sand, sand_ind[dep], sand_path[dep])
 
-                    self.eta.flat[update_ind] += self.Vp_dep / self.dx**2
-                    self.depth.flat[update_ind] = self.stage.flat[update_ind] - self.eta.flat[update_ind]
-                    update_uw = [min(self.u_max, self.qw.flat[i]/self.depth.flat[i]) for i in update_ind]
-                    self.uw.flat[update_ind] = update_uw
+                ero = (self.qs_sand.flat[sand_ind] < qs_cap) * (self.uw.flat[sand_ind] > self.U_ero_sand)
+                changed.append(self.update_bed(self.erode, sand_ind[ero], sand_path[ero], self.U_ero_sand))
 
-                    update_uwqw = [self.uw.flat[i]/self.qw.flat[i] if self.qw.flat[i]>0 else 0 for i in update_ind]
-                    self.ux.flat[update_ind] = self.qx.flat[update_ind] * update_uwqw
-                    self.uy.flat[update_ind] = self.qy.flat[update_ind] * update_uwqw
+                # mud: deposit in slow flow, erode in fast flow
+                mud_ind = these_indices[~sand]
+                mud_path = path_number[~sand]
 
+                dep = self.uw.flat[mud_ind] < self.U_dep_mud
+                changed.append(self.update_bed(self.deposit_mud, mud_ind[dep], mud_path[dep]))
 
-                if (self.uw.flat[these_indices] > self.U_ero_mud).any():
+                ero = self.uw.flat[mud_ind] > self.U_ero_mud
+                changed.append(self.update_bed(self.erode, mud_ind[ero], mud_path[ero], self.U_ero_mud))
 
-                    update_ind = these_indices[self.uw.flat[these_indices] > self.U_ero_mud]
-                    update_path = path_number[self.uw.flat[these_indices] > self.U_ero_mud]
+                changed = np.concatenate(changed)
+                if len(changed)>0:
+                    self.update_sed_weight(weight, changed)
 
-                    Vp_res_ = self.Vp_sed * (self.uw.flat[update_ind]**self.beta - self.U_ero_mud**self.beta) / (self.U_ero_mud**self.beta)
-                    self.Vp_ero = (self.stage.flat[update_ind] - self.eta.flat[update_ind])/4 * self.dx**2
-                    self.Vp_ero = np.array([min((Vp_res_[i],self.Vp_ero[i])) for i in range(len(self.Vp_ero))])
+                if it == self.itmax-1 or len(these_indices)==0:
+                    sed_continue = False
 
-                    self.eta.flat[update_ind] -= self.Vp_ero / self.dx**2
+        self.topo_diffusion()
 
-                    self.depth.flat[update_ind] = self.stage.flat[update_ind] - self.eta.flat[update_ind]
-                    update_uw = [min(self.u_max, self.qw.flat[i]/self.depth.flat[i]) for i in update_ind]
-                    self.uw.flat[update_ind] = update_uw
 
-                    update_uwqw = [self.uw.flat[i]/self.qw.flat[i] if self.qw.flat[i]>0 else 0 for i in update_ind]
-                    self.ux.flat[update_ind] = self.qx.flat[update_ind] * update_uwqw
-                    self.uy.flat[update_ind] = self.qy.flat[update_ind] * update_uwqw
 
-                    self.Vp_res[update_path] += self.Vp_ero
+    def add_sed_flux(self, indices, path_number, sed_class):
+        '''
+        Add the flux of the parcels path_number at indices to qs, and that
+        of the sand parcels to qs_sand
+        '''
 
+        flux = self.Vp_res[path_number]/2/self.dt/self.dx
+        scatter_add(self.qs, indices, flux)
 
-                if it == self.itmax-1 or len(these_indices)==0:
-                    sed_continue = False
+        sand = sed_class[path_number] == 0
+        scatter_add(self.qs_sand, indices[sand], flux[sand])
 
 
 
-    def one_coarse_timestep(self):
-        '''
-        Route all parcels of coarse sediment
+    def update_bed(self, rule, update_ind, update_path, *args):
         '''
+        Apply the deposition or erosion rule (with the extra arguments args)
+        to the parcels update_path at the cells update_ind
 
-        self.num_coarse = int(round(self.Np_sed*self.f_bedload))
+        update_ind must not have repeated cells in the rules and in
+        update_velocity_at, so parcels on the same cell are applied one
+        after the other. Return the cells that were updated
+        '''
 
-        if self.num_coarse>0:
+        for rnd in unique_rounds(update_ind):
+            rule(update_ind[rnd], update_path[rnd], *args)
 
-            these_indices = map(lambda x: self.random_pick_list(self.inlet),range(self.num_coarse))
-            these_indices = map(self.flatten_indices,these_indices)
+        return update_ind
 
-            self.indices = np.zeros((self.num_coarse,self.itmax), dtype=np.int)
-            self.indices[:,0] = these_indices
 
-            path_number = np.array(range(self.num_coarse))
-            self.Vp_res = np.zeros((self.Np_sed,)) + self.Vp_sed
-            self.qs.flat[these_indices] += self.Vp_res[path_number]/2/self.dt/self.dx
 
-            sed_continue = True
-            it = 0
+    def update_velocity_at(self, update_ind):
+        '''
+        Update the flow velocity at the cells update_ind after their bed changed
+        '''
 
-            while sed_continue:
+        qw = self.qw.flat[update_ind]
+        depth = self.depth.flat[update_ind]
 
-                weight = self.get_sed_weight()
+        # cells with zero depth get the maximum velocity
+        uw = np.full(len(update_ind), self.u_max)
+        np.divide(qw, depth, out=uw, where=depth!=0)
+        self.uw.flat[update_ind] = np.minimum(self.u_max, uw)
 
-                ngh = map(self.random_pick, weight[these_indices])
-                new_indices = these_indices + self.walk_flat[ngh]
-                new_ind_type = self.cell_type.flat[new_indices]
+        uw = self.uw.flat[update_ind]
+        update_uwqw = np.zeros(len(update_ind), dtype=np.result_type(uw, qw))
+        np.divide(uw, qw, out=update_uwqw, where=qw>0)
 
-                self.qs.flat[these_indices] += self.Vp_res[path_number]/2/self.dt/self.dx
-                self.qs.flat[new_indices] += self.Vp_res[path_number]/2/self.dt/self.dx
+        self.ux.flat[update_ind] = self.qx.flat[update_ind] * update_uwqw
+        self.uy.flat[update_ind] = self.qy.flat[update_ind] * update_uwqw
 
-                these_indices = new_indices[new_ind_type >= 0]
-                path_number = path_number[new_ind_type >= 0]
 
-                if len(path_number)>0:
-                    # check for looping
-                    keeper = np.ones((len(these_indices),), dtype=np.int)
-                    for i in range(len(these_indices)):
-                        if np.in1d(self.indices[path_number[i],:], these_indices[i]).any():
-                            keeper[i] = 0
-                        if these_indices[i]<0:
-                            keeper[i] = 0
-                    if np.min(keeper)==0:
-                        these_indices = these_indices[keeper == 1]
-                        path_number = path_number[keeper == 1]
 
-                it += 1
-                self.indices[path_number,it] = these_indices
+    def deposit_mud(self, update_ind, update_path):
+        '''
+        Deposit mud from the parcels update_path at the cells update_ind
+        '''
 
-                qs_cap = self.qs0 * self.f_bedload/self.u0**self.beta * self.uw.flat[these_indices]**self.beta
+        Vp_res_ = self.sed_lag * self.Vp_res[update_path] * \
+            (self.U_dep_mud**self.beta - self.uw.flat[update_ind]**self.beta) / (self.U_dep_mud**self.beta)
 
+        Vp_dep = (self.stage.flat[update_ind] - self.eta.flat[update_ind])/4 * self.dx**2
+        Vp_dep = np.minimum(Vp_res_, Vp_dep)
 
-                if (self.qs.flat[these_indices] > qs_cap).any():
+        self.Vp_dep_mud.flat[update_ind] += Vp_dep
+        self.Vp_res[update_path] -= Vp_dep
 
-                    update_ind = these_indices[self.qs.flat[these_indices] > qs_cap]
-                    update_path = path_number[self.qs.flat[these_indices] > qs_cap]
-                    Vp_res_ = self.Vp_res[update_path]
+        self.eta.flat[update_ind] += Vp_dep / self.dx**2
+        self.depth.flat[update_ind] = self.stage.flat[update_ind] - self.eta.flat[update_ind]
 
-                    self.Vp_dep = (self.stage.flat[update_ind] - self.eta.flat[update_ind])/4 * self.dx**2
-                    self.Vp_dep = np.array([min((Vp_res_[i],self.Vp_dep[i])) for i in range(len(update_ind))])
-                    eta_change = self.Vp_dep / self.dx**2
-                    self.Vp_res[update_path] -= self.Vp_dep
-                    self.Vp_dep_sand.flat[update_ind] += self.Vp_dep
+        self.update_velocity_at(update_ind)
 
-                    self.eta.flat[update_ind] += eta_change
 
-                    update_uw = [min(self.u_max, self.qw.flat[i]/self.depth.flat[i]) for i in update_ind]
-                    self.uw.flat[update_ind] = update_uw
 
-                    update_uwqw = [self.uw.flat[i]/self.qw.flat[i] if self.qw.flat[i]>0 else 0 for i in update_ind]
-                    self.ux.flat[update_ind] = self.qx.flat[update_ind] * update_uwqw
-                    self.uy.flat[update_ind] = self.qy.flat[update_ind] * update_uwqw
+    def erode(self, update_ind, update_path, U_ero):
+        '''
+        Erode sediment into the parcels update_path at the cells update_ind,
+        where the flow is faster than the erosion threshold U_ero
+        '''
 
+        Vp_res_ = self.Vp_sed * (self.uw.flat[update_ind]**self.beta - U_ero**self.beta) / (U_ero**self.beta)
 
-                if ((self.qs.flat[these_indices] < qs_cap) * (self.uw.flat[these_indices] > self.U_ero_sand)).any():
+        Vp_ero = (self.stage.flat[update_ind] - self.eta.flat[update_ind])/4 * self.dx**2
+        Vp_ero = np.minimum(Vp_res_, Vp_ero)
 
-                    update_ind = these_indices[(self.qs.flat[these_indices] < qs_cap) * (self.uw.flat[these_indices] > self.U_ero_sand)]
-                    update_path = path_number[(self.qs.flat[these_indices] < qs_cap) * (self.uw.flat[these_indices] > self.U_ero_sand)]
+        self.eta.flat[update_ind] -= Vp_ero / self.dx**2
+        self.depth.flat[update_ind] = self.stage.flat[update_ind] - self.eta.flat[update_ind]
 
-                    Vp_res_ = self.Vp_sed * (self.uw.flat[update_ind]**self.beta - self.U_ero_sand**self.beta) / (self.U_ero_sand**self.beta)
-                    Vp_ero_ = (self.stage.flat[update_ind] - self.eta.flat[update_ind])/4 * self.dx**2
-                    self.Vp_ero = np.array([min((Vp_res_[i],Vp_ero_[i])) for i in range(len(update_ind))])
+        self.update_velocity_at(update_ind)
 
-                    self.eta.flat[update_ind] -= self.Vp_ero / self.dx**2
-                    self.depth.flat[update_ind] = self.stage.flat[update_ind] - self.eta.flat[update_ind]
+        self.Vp_res[update_path] += Vp_ero
 
 
-                    update_uw = [min(self.u_max, self.qw.flat[i]/self.depth.flat[i]) for i in update_ind]
-                    self.uw.flat[update_ind] = update_uw
 
-                    update_uwqw = [self.uw.flat[i]/self.qw.flat[i] if self.qw.flat[i]>0 else 0 for i in update_ind]
-                    self.ux.flat[update_ind] = self.qx.flat[update_ind] * update_uwqw
-                    self.uy.flat[update_ind] = self.qy.flat[update_ind] * update_uwqw
+    def deposit_sand(self, update_ind, update_path):
+        '''
+        Deposit sand from the parcels update_path at the cells update_ind
+        '''
 
-                    self.Vp_res[update_path] += self.Vp_ero
+        Vp_dep = (self.stage.flat[update_ind] - self.eta.flat[update_ind])/4 * self.dx**2
+        Vp_dep = np.minimum(self.Vp_res[update_path], Vp_dep)
 
+        self.Vp_res[update_path] -= Vp_dep
+        self.Vp_dep_sand.flat[update_ind] += Vp_dep
 
-                if it == self.itmax-1 or len(these_indices)==0:
-                    sed_continue = False
+        self.eta.flat[update_ind] += Vp_dep / self.dx**2
 
-        self.topo_diffusion()
+        self.update_velocity_at(update_ind)
 
 
 
@@ -831,6 +1262,144 @@ class Tools(object):
 
 
 
+    #############################################
+    ################ checkpoints ################
+    #############################################
+
+    # arrays that are carried from one timestep to the next
+    _checkpoint_arrays = ['eta', 'stage', 'depth', 'qx', 'qy', 'qw',
+                          'qxn', 'qyn', 'qwn', 'ux', 'uy', 'uw', 'qs', 'qs_sand',
+                          'Vp_dep_sand', 'Vp_dep_mud', 'wgt_flat', '_active']
+
+    def save_checkpoint(self, filename):
+        '''
+        Save the state of the model between timesteps to filename
+        '''
+
+        arrays = dict((name, getattr(self, name)) for name in self._checkpoint_arrays)
+
+        # the snapshots queued so far are written before counting them
+        if self._output is not None:
+            for writer in self._grid_writers.values():
+                self._output.put(writer.flush)
+            self._output.flush()
+
+        grid_sizes = dict(self._grid_sizes)
+        grid_sizes.update((name, writer.size) for name, writer in self._grid_writers.items())
+
+        rows, cols = self.active_window
+        scalars = {'H_SL': self.H_SL, 'time': self._time,
+                   'time_step': self._time_step, 'spun_up': self._spun_up,
+                   'seed': self.rng.seed, 'batch': self.rng.batch,
+                   'active_window': [rows.start, rows.stop, cols.start, cols.stop],
+                   'grid_sizes': grid_sizes}
+
+        write_checkpoint(filename, arrays, scalars)
+
+
+
+    def load_checkpoint(self, filename):
+        '''
+        Restore the state saved by save_checkpoint in filename, copying
+        into the model arrays where the dtypes match
+        '''
+
+        arrays, scalars = read_checkpoint(filename)
+
+        for name in self._checkpoint_arrays:
+
+            array = getattr(self, name)
+
+            if array.shape != arrays[name].shape:
+                raise ValueError("The checkpoint '" + filename + "' has " + name + \
+                                 " of shape " + str(arrays[name].shape) + \
+                                 " instead of " + str(array.shape) + ".")
+
+            if array.dtype == arrays[name].dtype:
+                array[...] = arrays[name]
+            else:
+                setattr(self, name, np.array(arrays[name]))
+
+        self.H_SL = scalars['H_SL']
+        self._time = scalars['time']
+        self._time_step = scalars['time_step']
+        self._spun_up = scalars['spun_up']
+        self._warm_started = False
+        self.rng = RandomStreams(scalars['seed'], scalars['batch'])
+
+        r0, r1, c0, c1 = scalars['active_window']
+        self.active_window = (slice(r0, r1), slice(c0, c1))
+
+        # grid files opened before are closed, and reopened at these sizes
+        self.close_output()
+        self._grid_sizes = dict((str(name), size) for name, size in
+                                scalars.get('grid_sizes', {}).items())
+
+
+
+    #############################################
+    ################ warm start #################
+    #############################################
+
+    # inputs that determine the flow field after the first water iterations
+    _warm_start_vars = ['Length', 'Width', 'dx', 'L0_meters', 'S0', 'u0', 'N0_meters',
+                        'h0', 'H_SL', 'Np_water', 'itermax', 'conv_tol', 'Csmooth',
+                        'omega_sfc', 'omega_flow', 'Nsmooth', 'theta_water']
+
+    _warm_start_arrays = ['qx', 'qy', 'stage', 'depth']
+
+    def init_warm_start(self):
+        '''
+        Start from the spun-up flow field in the warm start cache
+        (warm_start_dir), if it has one for this grid and flow parameters
+        '''
+
+        self._spun_up = False
+        self._warm_started = False
+
+        if not self.warm_start_dir:
+            return
+
+        params = json.dumps([(k, getattr(self, k)) for k in self._warm_start_vars])
+        key = hashlib.sha1(params).hexdigest()[:16]
+
+        self._warm_start_file = os.path.join(self.warm_start_dir, 'flow_' + key + '.ckpt')
+
+        if os.path.exists(self._warm_start_file):
+
+            arrays, scalars = read_checkpoint(self._warm_start_file)
+
+            for name in self._warm_start_arrays:
+                setattr(self, name, np.array(arrays[name]))
+
+            self.qw = (self.qx**2 + self.qy**2)**(0.5)
+            self.update_velocity_field()
+
+            self.rng.batch += scalars.get('iterations', 0)
+
+            self._spun_up = True
+            self._warm_started = True
+
+            if self.verbose: print 'Warm start from ' + self._warm_start_file
+
+
+
+    def finalize_spin_up(self):
+        '''
+        Mark the flow field as spun up after the first water iterations
+        and save it to the warm start cache, unless another run already did
+        '''
+
+        self._spun_up = True
+
+        if self.warm_start_dir and not os.path.exists(self._warm_start_file):
+
+            arrays = dict((name, getattr(self, name)) for name in self._warm_start_arrays)
+            write_checkpoint(self._warm_start_file, arrays,
+                             {'iterations': self._iterations_used})
+
+
+
     #############################################
     ############## initialization ###############
     #############################################
@@ -902,8 +1471,7 @@ class Tools(object):
     def set_defaults(self):
     
     
-        self.random_pick = random_pick
-        self.random_pick_list = random_pick_list
+        self.random_pick_batch = random_pick_batch
         self.save_figure = save_figure
     
         for k,v in self._var_default_map.items():
@@ -940,9 +1508,18 @@ class Tools(object):
         self.dxn_ivec = [0,-SQ05,-1,-SQ05,0,SQ05,1,SQ05]
         self.dxn_jvec = [1,SQ05,0,-SQ05,-1,-SQ05,0,SQ05]
 
-        self.walk_flat = np.array([1, -49, -50, -51, -1, 49, 50, 51])
+        # shaped to broadcast against np.array((8,L,W))
+        self.dxn_ivec_nh = np.array(self.dxn_ivec)[:,np.newaxis,np.newaxis]
+        self.dxn_jvec_nh = np.array(self.dxn_jvec)[:,np.newaxis,np.newaxis]
+        self.dxn_dist_nh = np.array(self.dxn_dist)[:,np.newaxis,np.newaxis]
+
         self.walk = np.array([[0,1], [-SQ05, SQ05], [-1,0], [-SQ05,-SQ05], 
                               [0,-1], [SQ05,-SQ05], [1,0], [SQ05,SQ05]])
+
+        # walk = walk_steps[:,:2] + SQ05 * walk_steps[:,2:], with integer walk_steps
+        diagonal = (np.array(self.dxn_dist) > 1)[:,np.newaxis]
+        self.walk_steps = np.hstack([np.where(diagonal, 0, self.walk),
+                                     np.where(diagonal, np.sign(self.walk), 0)])
       
       
 
@@ -994,7 +1571,17 @@ class Tools(object):
         self.itmax = 2 * (self.L + self.W)      # max number of jumps for parcel
         self.dt = self.dVs / self.Qs0           # time step size
 
-        self.omega_flow_iter = 2 / self.itermax
+        self.omega_flow_iter = 2. / self.itermax
+
+        if self.figure_mode not in ('pcolor', 'image', 'png'):
+            raise ValueError("Unknown figure mode '" + str(self.figure_mode) + "'. " \
+                             "Please use pcolor, image or png.")
+
+        # halo around the active cells within which smoothing can act
+        self.window_halo = self.Nsmooth + 1
+
+        # random numbers of the parcels
+        self.rng = RandomStreams(self.seed)
  
         # number of times to repeat topo diffusion
         self.N_crossdiff = int(round(self.dVs / self.V0))
@@ -1033,8 +1620,20 @@ class Tools(object):
         self.uw = np.zeros_like(self.eta)
     
         self.wgt_flat = np.zeros((self.L*self.W,8))
+        self._buffers = {}
+        self._grid_writers = {}
+        self._grid_sizes = {}
+        self._figures = {}
+        self._output = None
+        self._closed_at_exit = False
+        self._pool = None
+
+        # everything is active until the first update of the active window
+        self._active = np.ones((self.L,self.W), dtype=np.bool)
+        self.active_window = self.full_window()
 
         self.qs = np.zeros_like(self.eta)
+        self.qs_sand = np.zeros_like(self.eta)
         self.Vp_dep_sand = np.zeros_like(self.eta)
         self.Vp_dep_mud = np.zeros_like(self.eta)
 
@@ -1064,3 +1663,9 @@ class Tools(object):
     
         self.inlet = list(np.unique(np.where(self.cell_type == 1)[1]))
         self.eta = self.stage - self.depth
+
+        ##### neighbors #####
+
+        self.walk_flat = flat_walk(self.W, self.dxn_iwalk, self.dxn_jwalk)
+        self.nbr_flat, self.nbr_type = neighbor_table(self.cell_type,
+                                                      self.dxn_iwalk, self.dxn_jwalk)
@@ -1,40 +1,943 @@
 import numpy as np
 import os
-from matplotlib import pyplot as plt
+import sys
+import zlib
+import struct
+import json
+import tempfile
+import threading
+import Queue
 
+# matplotlib is only imported when a figure is saved, and scipy (optional)
+# when the first array is filtered
 
+# scipy.ndimage once it is imported, False if scipy is not installed
+_ndimage = None
 
-def random_pick(probs, num_options=8):
+
+
+def random_pick_batch(probs, rand):
+    '''
+    Randomly pick one number for each row of probs (shape (n,8))
+    using one uniform random number in [0,1) per row
+
+    Rows with all zero weights are split equally among all options
+
+    Return an array with the index of the selected weight in each row
+    '''
+
+    probs = np.asarray(probs, dtype=np.float64)
+    num_options = probs.shape[1]
+
+    cutoffs = np.cumsum(probs, axis=1)
+
+    empty = cutoffs[:,-1] <= 0
+    if empty.any():
+        cutoffs[empty] = np.arange(1, num_options+1) / float(num_options)
+
+    target = np.asarray(rand) * cutoffs[:,-1]
+
+    # same as searchsorted on each row: count the cutoffs below the target
+    idx = np.sum(cutoffs < target[:,np.newaxis], axis=1)
+
+    return np.minimum(idx, num_options-1)
+
+
+
+def splitmix64(x):
+    '''
+    SplitMix64 hash of an array of np.uint64, wrapping around on overflow
+    '''
+
+    x = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+
+    return x ^ (x >> np.uint64(31))
+
+
+
+class RandomStreams(object):
+    '''
+    Counter-based random numbers for the parcels
+
+    Each batch of parcels (one water iteration or one sediment timestep)
+    gets its own stream from next_stream. A random number is a hash of
+    the seed, the batch, the parcel number and the step of the parcel,
+    so it does not depend on which other parcels are routed with it or
+    in what order
+
+    >>> streams = RandomStreams(42)
+    >>> stream = streams.next_stream()
+    >>> all_parcels = stream.uniform(np.arange(6), 3)
+    >>> some_parcels = stream.uniform(np.array([4, 1]), 3)
+    >>> (some_parcels == all_parcels[[4, 1]]).all()
+    True
+    >>> (streams.next_stream().uniform(np.arange(6), 3) != all_parcels).all()
+    True
+    '''
+
+    def __init__(self, seed = 0, batch = 0):
+
+        self.seed = seed
+        self.batch = batch
+
+
+    def next_stream(self):
+        '''
+        Get the stream of the next batch of parcels
+        '''
+
+        key = splitmix64([self.seed])
+        key = splitmix64(key ^ np.uint64(self.batch))
+
+        self.batch += 1
+
+        return ParcelStream(key)
+
+
+
+class ParcelStream(object):
+    '''
+    Random numbers of one batch of parcels (see RandomStreams)
+    '''
+
+    def __init__(self, key):
+
+        self.key = key
+
+
+    def uniform(self, parcels, step):
+        '''
+        Get one uniform random number in [0,1) for each parcel at step
+        '''
+
+        x = splitmix64(self.key ^ np.asarray(parcels, dtype=np.uint64))
+        x = splitmix64(x ^ np.uint64(step))
+
+        return (x >> np.uint64(11)).astype(np.float64) * (1. / 2**53)
+
+
+    def choice(self, options, parcels, step):
+        '''
+        Pick one of options with equal probability for each parcel at step
+        '''
+
+        options = np.asarray(options)
+        pick = (self.uniform(parcels, step) * len(options)).astype(np.int)
+
+        return options[pick]
+
+
+
+def flat_walk(W, dxn_iwalk, dxn_jwalk):
+    '''
+    Offsets between the flat index of a cell and the flat indices
+    of its 8 neighbors in a grid with W columns
+
+    >>> iwalk = [1,1,0,-1,-1,-1,0,1]
+    >>> jwalk = [0,1,1,1,0,-1,-1,-1]
+    >>> flat_walk(50, iwalk, jwalk).tolist()
+    [1, -49, -50, -51, -1, 49, 50, 51]
+    >>> flat_walk(7, iwalk, jwalk).tolist()
+    [1, -6, -7, -8, -1, 6, 7, 8]
+    '''
+
+    return np.array(dxn_iwalk) - W * np.array(dxn_jwalk)
+
+
+
+def neighbor_table(cell_type, dxn_iwalk, dxn_jwalk):
+    '''
+    Get np.array((L*W,8)) with the flat index of each neighbor of every cell
+    and np.array((L*W,8)) with the cell_type of that neighbor
+
+    Neighbors outside of the grid point back to the cell itself and
+    get cell_type -2 (land), so parcels can never step off the grid
+
+    >>> iwalk = [1,1,0,-1,-1,-1,0,1]
+    >>> jwalk = [0,1,1,1,0,-1,-1,-1]
+    >>> cell_type = np.zeros((3,4), dtype=np.int)
+    >>> cell_type[2,:] = -1
+    >>> nbr, nbr_type = neighbor_table(cell_type, iwalk, jwalk)
+    >>> nbr[5].tolist()
+    [6, 2, 1, 0, 4, 8, 9, 10]
+    >>> nbr_type[5].tolist()
+    [0, 0, 0, 0, 0, -1, -1, -1]
+    >>> nbr[0].tolist()
+    [1, 0, 0, 0, 0, 0, 4, 5]
+    >>> nbr_type[0].tolist()
+    [0, -2, -2, -2, -2, -2, 0, 0]
+    '''
+
+    L, W = cell_type.shape
+
+    cells = np.arange(L*W)
+    rows = cells // W
+    cols = cells % W
+
+    nh_rows = rows[:,np.newaxis] - np.array(dxn_jwalk)
+    nh_cols = cols[:,np.newaxis] + np.array(dxn_iwalk)
+
+    inside = (nh_rows >= 0) & (nh_rows < L) & (nh_cols >= 0) & (nh_cols < W)
+
+    nbr = np.where(inside, nh_rows * W + nh_cols, cells[:,np.newaxis])
+    nbr_type = np.where(inside, cell_type.flat[nbr], -2).astype(cell_type.dtype)
+
+    return nbr, nbr_type
+
+
+
+def scatter_add(array, indices, values):
+    '''
+    Add values to array at the flat indices, in place
+
+    Unlike array.flat[indices] += values, every repeated index
+    receives its own contribution
+
+    >>> a = np.zeros((2,3))
+    >>> scatter_add(a, [4, 4, 0], [1., 2., 3.])
+    >>> a.tolist()
+    [[3.0, 0.0, 0.0], [0.0, 3.0, 0.0]]
+    '''
+
+    np.add.at(array, np.unravel_index(indices, array.shape), values)
+
+
+
+def unique_rounds(indices):
+    '''
+    Split the positions in indices into rounds in which no value repeats
+
+    Positions with the same value are assigned to consecutive rounds in
+    their original order, so applying the rounds one after the other is
+    the same as applying every position in order
+
+    >>> [r.tolist() for r in unique_rounds([4, 2, 4, 4, 2])]
+    [[0, 1], [2, 4], [3]]
+    '''
+
+    indices = np.asarray(indices)
+    n = len(indices)
+
+    if n == 0:
+        return []
+
+    order = np.argsort(indices, kind='mergesort')
+    sorted_ind = indices[order]
+
+    # position of the first entry of each group of equal values
+    group_start = np.r_[True, sorted_ind[1:] != sorted_ind[:-1]]
+    group_start = np.maximum.accumulate(np.where(group_start, np.arange(n), 0))
+
+    rank = np.empty(n, dtype=np.int)
+    rank[order] = np.arange(n) - group_start
+
+    return [np.nonzero(rank == r)[0] for r in range(rank.max()+1)]
+
+
+
+def uniform_filter(array):
+    '''
+    Mean of the 3x3 window around each cell of a 2D array
+
+    Same as scipy.ndimage.uniform_filter(array) (the edges are reflected),
+    which is used if scipy is installed
+
+    >>> uniform_filter(np.array([[0., 9.], [9., 0.]])).tolist()
+    [[4.0, 5.0], [5.0, 4.0]]
+    '''
+
+    global _ndimage
+
+    if _ndimage is None:
+        try:
+            from scipy import ndimage as _ndimage
+        except ImportError:
+            _ndimage = False
+
+    if _ndimage:
+        return _ndimage.uniform_filter(array)
+
+    padded = np.pad(array, 1, mode='symmetric')
+
+    rows = padded[:-2] + padded[1:-1] + padded[2:]
+    window_sum = rows[:,:-2] + rows[:,1:-1] + rows[:,2:]
+
+    return window_sum / 9.
+
+
+
+class PathStore(object):
+    '''
+    Append-only store of the cells visited by a set of parcels
+
+    Each jump appends the (parcel, cell) pairs of the parcels that moved,
+    as int32, so memory follows the actual length of the paths instead of
+    a dense (n_parcels, itmax) matrix. The per-parcel offsets into the
+    store are built when the paths are read
+
+    >>> store = PathStore(3)
+    >>> store.append([0, 1, 2], [10, 11, 12])
+    >>> store.append([0, 2], [20, 22])
+    >>> store.append([2], [32])
+    >>> cells, path_len = store.paths([2, 0])
+    >>> cells.tolist(), path_len.tolist()
+    ([12, 22, 32, 10, 20], [3, 2])
+    >>> store.count_cells(40)[[10, 20, 22]].tolist()
+    [1, 1, 1]
+
+    Paths that are not needed can be discarded, and the store drops them
+    once they take up half of it
+
+    >>> store.discard([0, 1])
+    >>> store.size
+    3
+    >>> store.paths([2])[0].tolist()
+    [12, 22, 32]
+
+    Stores of different parcels can be joined
+
+    >>> other = PathStore(3)
+    >>> other.append([1], [41])
+    >>> joined = PathStore.concatenate([store, other], 3)
+    >>> joined.paths([1, 2])[0].tolist()
+    [41, 12, 22, 32]
+    '''
+
+    def __init__(self, n_parcels, capacity = 1024):
+
+        self.n_parcels = n_parcels
+        self.parcels = np.empty((capacity,), dtype=np.int32)
+        self.cells = np.empty((capacity,), dtype=np.int32)
+        self.size = 0
+
+        self.path_len = np.zeros((n_parcels,), dtype=np.int)
+        self.discarded = np.zeros((n_parcels,), dtype=np.bool)
+        self.n_discarded = 0
+
+
+    def append(self, parcels, cells):
+        '''
+        Add one step of the paths of parcels
+        '''
+
+        n = len(cells)
+
+        if self.size + n > len(self.cells):
+
+            capacity = max(2 * len(self.cells), self.size + n)
+
+            self.parcels = np.resize(self.parcels, (capacity,))
+            self.cells = np.resize(self.cells, (capacity,))
+
+        self.parcels[self.size:self.size+n] = parcels
+        self.cells[self.size:self.size+n] = cells
+        self.size += n
+
+        # each parcel moves at most once per step
+        self.path_len[parcels] += 1
+
+
+    def discard(self, parcels):
+        '''
+        Mark the paths of parcels as not needed
+
+        Their cells are dropped from the store, and from count_cells,
+        once discarded paths take up half of the store
+        '''
+
+        parcels = np.asarray(parcels, dtype=np.int)
+        parcels = parcels[~self.discarded[parcels]]
+
+        self.discarded[parcels] = True
+        self.n_discarded += np.sum(self.path_len[parcels])
+
+        if 2 * self.n_discarded >= self.size:
+
+            keep = ~self.discarded[self.parcels[:self.size]]
+            n = np.sum(keep)
+
+            self.parcels[:n] = self.parcels[:self.size][keep]
+            self.cells[:n] = self.cells[:self.size][keep]
+            self.size = n
+
+            self.path_len[self.discarded] = 0
+            self.n_discarded = 0
+
+
+    def kept(self):
+        '''
+        Get the parcels and cells of the paths that were not discarded
+        '''
+
+        parcels = self.parcels[:self.size]
+        keep = ~self.discarded[parcels]
+
+        return parcels[keep], self.cells[:self.size][keep]
+
+
+    @classmethod
+    def concatenate(cls, stores, n_parcels):
+        '''
+        Join the paths that were not discarded from stores of
+        different parcels into a new store
+        '''
+
+        kept = [s.kept() for s in stores]
+
+        store = cls(n_parcels, capacity = 0)
+        store.parcels = np.concatenate([k[0] for k in kept])
+        store.cells = np.concatenate([k[1] for k in kept])
+        store.size = len(store.cells)
+        store.path_len = np.bincount(store.parcels, minlength=n_parcels)
+
+        return store
+
+
+    def offsets(self):
+        '''
+        Get the order that sorts the store by parcel (keeping the order of
+        the steps) and the offset of the path of each parcel in that order
+        '''
+
+        parcels = self.parcels[:self.size]
+
+        order = np.argsort(parcels, kind='mergesort')
+        path_len = np.bincount(parcels, minlength=self.n_parcels)
+
+        return order, np.r_[0, np.cumsum(path_len)]
+
+
+    def paths(self, parcels):
+        '''
+        Get the paths of parcels, end to end in the order of parcels,
+        and the number of cells in each path
+        '''
+
+        parcels = np.asarray(parcels, dtype=np.int)
+
+        order, offsets = self.offsets()
+
+        path_len = offsets[parcels+1] - offsets[parcels]
+        path_start = np.cumsum(path_len) - path_len
+
+        pos = np.arange(np.sum(path_len)) - np.repeat(path_start, path_len)
+        ind = np.repeat(offsets[parcels], path_len) + pos
+
+        return self.cells[order[ind]], path_len
+
+
+    def count_cells(self, n_cells):
+        '''
+        Count the number of visits to each of n_cells cells
+        '''
+
+        return np.bincount(self.cells[:self.size], minlength=n_cells)
+
+
+
+class CellCounts(object):
+    '''
+    Running sums over the flat cells of the rows of weights picked by
+    kind, or of 1 if there are no weights
+
+    The cells added are buffered and counted with bincount once there are
+    n_cells of them, so the memory does not grow with the number added
+
+    >>> counts = CellCounts(4, np.array([[1, 0], [0, -1]]))
+    >>> counts.add(np.array([0, 3, 3]), np.array([0, 1, 1]))
+    >>> counts.totals().tolist()
+    [[1.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, -2.0]]
+    '''
+
+    def __init__(self, n_cells, weights = None):
+
+        self.n_cells = n_cells
+        self.weights = weights
+
+        if weights is None:
+            self.sums = np.zeros((n_cells,), dtype=np.int)
+        else:
+            self.sums = np.zeros((weights.shape[1], n_cells))
+
+        self.cells = []
+        self.kinds = []
+        self.n_buffered = 0
+
+
+    def add(self, cells, kinds = None):
+        '''
+        Add the weights of kinds (or 1) at cells
+        '''
+
+        self.cells.append(cells)
+        self.kinds.append(kinds)
+        self.n_buffered += len(cells)
+
+        if self.n_buffered >= self.n_cells:
+            self.flush()
+
+
+    def flush(self):
+        '''
+        Count the buffered cells into the sums
+        '''
+
+        if self.n_buffered == 0:
+            return
+
+        cells = np.concatenate(self.cells)
+
+        if self.weights is None:
+            self.sums += np.bincount(cells, minlength=self.n_cells)
+        else:
+            weights = self.weights[np.concatenate(self.kinds)]
+            for k in range(len(self.sums)):
+                self.sums[k] += np.bincount(cells, weights[:,k], self.n_cells)
+
+        self.cells = []
+        self.kinds = []
+        self.n_buffered = 0
+
+
+    def totals(self):
+        '''
+        Get the sums of everything added
+        '''
+
+        self.flush()
+
+        return self.sums
+
+
+
+class VisitedCells(object):
+    '''
+    Hashed set of the int64 keys (>= 0) of the (parcel, cell) pairs visited
+    by parcels, with linear probing on a numpy table kept at most half full,
+    so adding or looking up a key takes O(1) expected probes
+
+    >>> visited = VisitedCells([3, 7])
+    >>> visited.add([5, 3]).tolist()
+    [True, False]
+    >>> visited.contains([3, 4, 5]).tolist()
+    [True, False, True]
+    '''
+
+    def __init__(self, keys = ()):
+
+        self.size = 0
+        self.table = np.empty((16,), dtype=np.int64)
+        self.table.fill(-1)
+
+        self.add(keys)
+
+
+    def slots(self, keys):
+        '''
+        Get the first slot of the table probed for each key (Fibonacci hashing)
+        '''
+
+        bits = len(self.table).bit_length() - 1
+        hashed = keys.astype(np.uint64) * np.uint64(11400714819323198485)
+
+        return (hashed >> np.uint64(64 - bits)).astype(np.intp)
+
+
+    def add(self, keys):
+        '''
+        Add keys to the set and get a boolean array that is True for the
+        keys that were not in it yet
+        '''
+
+        keys = np.asarray(keys, dtype=np.int64).ravel()
+        new = np.zeros(keys.shape, dtype=np.bool)
+
+        if 2 * (self.size + len(keys)) > len(self.table):
+            self.grow(self.size + len(keys))
+
+        mask = len(self.table) - 1
+        pending = np.arange(len(keys))
+        slot = self.slots(keys)
+
+        while len(pending) > 0:
+
+            current = self.table[slot]
+            probing = current != keys[pending]
+
+            # of the keys probing the same free slot, one is written
+            free = np.flatnonzero(current == -1)
+            self.table[slot[free]] = keys[pending[free]]
+
+            written = free[self.table[slot[free]] == keys[pending[free]]]
+            new[pending[written]] = True
+            probing[written] = False
+
+            pending = pending[probing]
+            slot = (slot[probing] + 1) & mask
+
+        self.size += np.count_nonzero(new)
+
+        return new
+
+
+
+    def grow(self, n_keys):
+        '''
+        Rehash the keys into a table with room for n_keys
+        '''
+
+        keys = self.table[self.table >= 0]
+
+        # grow 4 times, so the keys are rehashed less often
+        size = 4 * len(self.table)
+        while size < 2 * n_keys:
+            size *= 2
+
+        self.size = 0
+        self.table = np.empty((size,), dtype=np.int64)
+        self.table.fill(-1)
+
+        self.add(keys)
+
+
+    def contains(self, keys):
+        '''
+        Get a boolean array that is True for the keys in the set
+        '''
+
+        keys = np.asarray(keys, dtype=np.int64)
+
+        found = np.zeros(keys.shape, dtype=np.bool)
+
+        mask = len(self.table) - 1
+        pending = np.flatnonzero(keys >= 0)
+        slot = self.slots(keys.ravel()[pending])
+
+        while len(pending) > 0:
+
+            current = self.table[slot]
+            hit = current == keys.ravel()[pending]
+            found.ravel()[pending[hit]] = True
+
+            probing = ~hit & (current >= 0)
+            pending = pending[probing]
+            slot = (slot[probing] + 1) & mask
+
+        return found
+
+
+
+class GridWriter(object):
+    '''
+    Stream snapshots of a 2D grid to a .npy file on disk
+
+    The file holds an np.array((n_saves,L,W)) that is memory-mapped, so each
+    snapshot is copied into the page cache and written out by the OS
+    without keeping the history in memory. The array grows if more than
+    n_saves snapshots are appended, and is trimmed to the number of
+    snapshots when the writer is closed
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> writer = GridWriter(os.path.join(tmp, 'eta_grids'), (2, 3), 1)
+    >>> for i in range(3):
+    ...     writer.append(np.zeros((2, 3)) + i)
+    >>> writer.close()
+    >>> grids = np.load(os.path.join(tmp, 'eta_grids.npy'))
+    >>> grids.shape, grids[:,0,0].tolist()
+    ((3, 2, 3), [0.0, 1.0, 2.0])
+
+    With size, the first size snapshots of an existing file are kept and
+    the next ones written after them (to continue a restarted run)
+
+    >>> writer = GridWriter(os.path.join(tmp, 'eta_grids'), (2, 3), 1, size = 2)
+    >>> writer.append(np.zeros((2, 3)) + 5)
+    >>> writer.close()
+    >>> np.load(os.path.join(tmp, 'eta_grids.npy'))[:,0,0].tolist()
+    [0.0, 1.0, 5.0]
+    >>> shutil.rmtree(tmp)
+    '''
+
+    def __init__(self, path, shape, n_saves, dtype = np.float64, size = 0):
+
+        directory = os.path.split(path)[0]
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.path = path + '.npy'
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.size = size
+
+        if size == 0:
+            self.grids = np.lib.format.open_memmap(self.path, mode='w+', dtype=dtype,
+                                                   shape=(max(n_saves, 1),) + self.shape)
+            return
+
+        if not os.path.exists(self.path):
+            raise ValueError("The grid file '" + self.path + "' to continue does not exist.")
+
+        self.grids = np.lib.format.open_memmap(self.path, mode='r+')
+
+        if self.grids.shape[1:] != self.shape or self.grids.shape[0] < size or \
+           self.grids.dtype != np.dtype(dtype):
+            shape = self.grids.shape
+            self.grids = None
+            raise ValueError("The grid file '" + self.path + "' has shape " + str(shape) + \
+                             " instead of at least " + str((size,) + self.shape) + ".")
+
+
+    def append(self, grid):
+        '''
+        Write grid as the next snapshot
+        '''
+
+        if self.size == self.grids.shape[0]:
+            self._resize(2 * self.size)
+
+        self.grids[self.size] = grid
+        self.size += 1
+
+
+    def flush(self):
+        '''
+        Write the snapshots still in the page cache to disk
+        '''
+
+        if self.grids is not None:
+            self.grids.flush()
+
+
+    def close(self):
+        '''
+        Trim the file to the snapshots written and close it
+        '''
+
+        if self.grids is None:
+            return
+
+        if self.size != self.grids.shape[0]:
+            self._resize(self.size)
+
+        self.flush()
+        self.grids = None
+
+
+    def _resize(self, n_saves):
+        '''
+        Copy the snapshots into a file with room for n_saves of them
+        '''
+
+        tmp_path = self.path + '.tmp'
+        grids = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype,
+                                          shape=(n_saves,) + self.shape)
+
+        n = min(self.size, n_saves)
+        for i in range(n):
+            grids[i] = self.grids[i]
+
+        grids.flush()
+        del grids
+
+        self.grids = None
+        os.rename(tmp_path, self.path)
+        self.grids = np.lib.format.open_memmap(self.path, mode='r+')
+
+
+
+_checkpoint_magic = 'DRCMCKPT'
+_checkpoint_align = 64
+
+
+
+def _aligned(offset):
+    '''
+    Round offset up to a multiple of _checkpoint_align
+    '''
+
+    return -(-offset // _checkpoint_align) * _checkpoint_align
+
+
+
+def write_checkpoint(path, arrays, scalars):
+    '''
+    Write the dict of arrays and the dict of scalars (any JSON values)
+    to a single checkpoint file
+
+    The file has a magic string, the length of a JSON header and the
+    header, followed by the raw data of each array aligned to 64 bytes,
+    so read_checkpoint can memory-map the arrays. The file is written to
+    a new temporary file next to path and renamed, so an existing
+    checkpoint is only replaced by a complete one, even when several
+    processes write path at the same time
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> path = os.path.join(tmp, 'state.ckpt')
+    >>> write_checkpoint(path, {'eta': np.arange(6.).reshape(2, 3),
+    ...                         'mask': np.array([True, False])}, {'time': 2.0})
+    >>> arrays, scalars = read_checkpoint(path)
+    >>> arrays['eta'].tolist(), arrays['mask'].tolist(), scalars['time']
+    ([[0.0, 1.0, 2.0], [3.0, 4.0, 5.0]], [True, False], 2.0)
+    >>> del arrays; shutil.rmtree(tmp)
+    '''
+
+    entries = []
+    offset = 0
+
+    for name in sorted(arrays):
+        array = np.ascontiguousarray(arrays[name])
+        entries.append({'name': name, 'dtype': array.dtype.str,
+                        'shape': list(array.shape), 'offset': offset})
+        offset = _aligned(offset + array.nbytes)
+
+    header = json.dumps({'arrays': entries, 'scalars': scalars})
+    data_start = _aligned(len(_checkpoint_magic) + 4 + len(header))
+
+    directory = os.path.split(path)[0]
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    fd, tmp_path = tempfile.mkstemp(dir = directory or '.',
+                                    prefix = os.path.basename(path) + '.',
+                                    suffix = '.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+
+            f.write(_checkpoint_magic + struct.pack('<I', len(header)) + header)
+
+            for entry in entries:
+                f.seek(data_start + entry['offset'])
+                f.write(np.ascontiguousarray(arrays[entry['name']]).tostring())
+
+        os.rename(tmp_path, path)
+
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+
+def read_checkpoint(path):
     '''
-    Randomly pick a number weighted by array probs (len 8)
-    Return the index of the selected weight in array probs
+    Read a checkpoint written by write_checkpoint
+
+    Returns a dict of read-only memory-mapped arrays and the dict of scalars
     '''
 
-    if np.max(probs) == 0:
-        probs = list([1/num_options for i in range(num_options)])
+    with open(path, 'rb') as f:
+
+        if f.read(len(_checkpoint_magic)) != _checkpoint_magic:
+            raise IOError(path + ' is not a deltaRCM checkpoint')
+
+        n = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(n))
+
+    data_start = _aligned(len(_checkpoint_magic) + 4 + n)
+
+    arrays = {}
+
+    for entry in header['arrays']:
 
-    cutoffs = np.cumsum(probs)
-    idx = cutoffs.searchsorted(np.random.uniform(0, cutoffs[-1]))
+        shape = tuple(entry['shape'])
 
-    return idx
+        if np.prod(shape) == 0:
+            arrays[entry['name']] = np.zeros(shape, dtype=entry['dtype'])
+        else:
+            arrays[entry['name']] = np.memmap(path, dtype=entry['dtype'], mode='r',
+                                              offset=data_start + entry['offset'],
+                                              shape=shape)
 
+    return arrays, header['scalars']
 
 
-def random_pick_list(choices, probs = None):
+
+class OutputQueue(object):
     '''
-    Randomly pick a number from array choices weighted by array probs
-    Values in choices are column indices
+    Run output jobs in order on a background thread
+
+    put blocks while maxsize jobs are waiting, so a slow disk or
+    renderer holds back the model instead of piling up snapshots in
+    memory. Errors raised by a job are raised again by the next
+    put, flush or close
 
-    Return a tuple of the randomly picked index for row 0
+    >>> out = OutputQueue()
+    >>> done = []
+    >>> for i in range(3):
+    ...     out.put(done.append, i)
+    >>> out.flush()
+    >>> done
+    [0, 1, 2]
+    >>> out.close()
     '''
 
-    if not probs:
-        probs = list([1 for i in range(len(choices))])
+    def __init__(self, maxsize = 4):
+
+        self.jobs = Queue.Queue(maxsize)
+        self.error = None
+
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
 
-    cutoffs = np.cumsum(probs)
-    idx = cutoffs.searchsorted(np.random.uniform(0, cutoffs[-1]))
+    def put(self, func, *args):
+        '''
+        Queue the job func(*args)
+        '''
+
+        self._raise_error()
+        self.jobs.put((func, args))
+
+
+    def flush(self):
+        '''
+        Wait until all queued jobs are done
+        '''
+
+        self.jobs.join()
+        self._raise_error()
+
+
+    def close(self):
+        '''
+        Finish the queued jobs and stop the thread
+        '''
+
+        if self.thread.is_alive():
+            self.jobs.put((None, ()))
+            self.thread.join()
+
+        self._raise_error()
+
+
+    def _run(self):
+
+        while True:
+
+            func, args = self.jobs.get()
+
+            try:
+                if func is not None:
+                    func(*args)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.jobs.task_done()
+
+            if func is None:
+                return
+
+
+    def _raise_error(self):
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
 
-    return (0,choices[idx])
 
 
     
@@ -50,6 +953,132 @@ def save_figure(path, ext='png', close=True):
         backends support 'png', 'pdf', 'ps', 'eps', and 'svg'.
     '''
 
+    from matplotlib import pyplot as plt
+
+    plt.savefig(figure_path(path, ext))
+
+    if close: plt.close()
+
+
+
+def save_grid_figure(path, grid, ext='png'):
+    '''
+    Save a pcolor plot of grid, with a colorbar
+
+    Does not use pyplot, so it can be called from a background thread
+    (see save_figure for path and ext)
+    '''
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure()
+    canvas = FigureCanvasAgg(fig)
+
+    ax = fig.add_subplot(111)
+    fig.colorbar(ax.pcolor(grid))
+
+    canvas.print_figure(figure_path(path, ext))
+
+
+
+class GridFigure(object):
+    '''
+    Persistent figure of a grid, drawn with imshow and a colorbar
+
+    Each call to save only replaces the image data and color limits,
+    so the axes and colorbar are built once. The image has its origin
+    in the lower left corner, like the pcolor plots of save_grid_figure
+    '''
+
+    def __init__(self):
+
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.fig = Figure()
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.image = None
+
+
+    def save(self, path, grid, ext='png'):
+        '''
+        Draw grid and save the figure (see save_figure for path and ext)
+        '''
+
+        if self.image is None or self.image.get_array().shape != grid.shape:
+
+            self.fig.clf()
+            ax = self.fig.add_subplot(111)
+            self.image = ax.imshow(grid, origin='lower', interpolation='nearest',
+                                   aspect='auto', extent=(0, grid.shape[1], 0, grid.shape[0]))
+            self.fig.colorbar(self.image)
+
+        else:
+            self.image.set_data(grid)
+
+        self.image.set_clim(np.min(grid), np.max(grid))
+
+        self.canvas.print_figure(figure_path(path, ext))
+
+
+
+# anchors of a perceptually uniform blue-green-yellow colormap
+_png_colors = np.array([[68, 1, 84], [59, 82, 139], [33, 145, 140],
+                        [94, 201, 98], [253, 231, 37]], dtype=np.float)
+
+_png_lut = np.column_stack([np.interp(np.linspace(0, 1, 256),
+                                      np.linspace(0, 1, len(_png_colors)), c)
+                            for c in _png_colors.T]).astype(np.uint8)
+
+
+
+def write_png(path, grid):
+    '''
+    Save grid as a colormapped 8-bit RGB PNG image, one pixel per cell
+
+    Row 0 of grid is the bottom row of the image. Writes the PNG chunks
+    directly with zlib, without matplotlib
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> write_png(os.path.join(tmp, 'eta'), np.arange(6.).reshape(2, 3))
+    >>> data = open(os.path.join(tmp, 'eta.png'), 'rb').read()
+    >>> data[:8] == '\\x89PNG\\r\\n\\x1a\\n', struct.unpack('>II', data[16:24])
+    (True, (3, 2))
+    >>> shutil.rmtree(tmp)
+    '''
+
+    grid = np.asarray(grid, dtype=np.float)
+    gmin, gmax = np.min(grid), np.max(grid)
+
+    scaled = (grid - gmin) * (255. / max(gmax - gmin, 1e-12))
+    rgb = _png_lut[scaled.astype(np.uint8)][::-1]
+
+    # each scanline starts with filter type 0 (none)
+    L, W = grid.shape
+    raw = np.zeros((L, 1 + 3*W), dtype=np.uint8)
+    raw[:,1:] = rgb.reshape(L, 3*W)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + \
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    png = '\x89PNG\r\n\x1a\n' + \
+        chunk('IHDR', struct.pack('>IIBBBBB', W, L, 8, 2, 0, 0, 0)) + \
+        chunk('IDAT', zlib.compress(raw.tostring(), 6)) + \
+        chunk('IEND', '')
+
+    with open(figure_path(path, 'png'), 'wb') as f:
+        f.write(png)
+
+
+
+def figure_path(path, ext):
+    '''
+    Path of the figure file, creating its directory if needed
+    '''
+
     directory = os.path.split(path)[0]
     filename = "%s.%s" % (os.path.split(path)[1], ext)
     if directory == '': directory = '.'
@@ -57,7 +1086,4 @@ def save_figure(path, ext='png', close=True):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    savepath = os.path.join(directory, filename)
-    plt.savefig(savepath)
-
-    if close: plt.close()
\ No newline at end of file
+    return os.path.join(directory, filename)
\ No newline at end of file
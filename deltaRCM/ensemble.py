@@ -0,0 +1,329 @@
+#! /usr/bin/env python
+"""Run ensembles of deltaRCM realizations in a pool of processes."""
+
+import os
+import re
+import multiprocessing
+
+import numpy as np
+
+from .bmi_deltaRCM import BmiDeltaRCM
+from .deltaRCM import DeltaRCM
+from .deltaRCM_tools import GridWriter
+
+
+# memory used by a worker process besides the model arrays
+_process_overhead = 64 * 2**20
+
+
+def read_parameter_table(filename):
+    """Read a table of input file values, one ensemble member per row.
+
+    The first line has the input file keys (for example
+    model__random_seed) and each following line the values of one member,
+    separated by commas or spaces. Lines starting with # are skipped.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the table.
+
+    Returns
+    -------
+    list of dict
+        The values of each member, by key.
+    """
+    rows = []
+
+    with open(filename) as table:
+        for line in table:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                rows.append(re.split(r'\s*,\s*|\s+', line))
+
+    keys = rows[0]
+
+    return [dict(zip(keys, row)) for row in rows[1:]]
+
+
+def write_member_input(input_file, params, filename):
+    """Write the input file of an ensemble member.
+
+    The lines of params are added after the lines of input_file, so they
+    replace the values of input_file.
+
+    Parameters
+    ----------
+    input_file : str
+        Path to the base input file.
+    params : dict
+        Values of the input file keys of the member.
+    filename : str
+        Path of the input file of the member.
+    """
+    with open(input_file) as base:
+        lines = base.read().rstrip('\n').split('\n')
+
+    lines.extend(['%s : %s' % (k, v) for k, v in sorted(params.items())])
+
+    with open(filename, 'w') as member:
+        member.write('\n'.join(lines) + '\n')
+
+
+def available_memory():
+    """Memory available for new processes.
+
+    Returns
+    -------
+    int or None
+        MemAvailable (or MemFree) of /proc/meminfo in bytes, None if it
+        can't be read.
+    """
+    try:
+        with open('/proc/meminfo') as meminfo:
+            info = dict(line.split(':', 1) for line in meminfo)
+    except (IOError, ValueError):
+        return None
+
+    for key in ('MemAvailable', 'MemFree'):
+        if key in info:
+            return int(info[key].split()[0]) * 1024
+
+    return None
+
+
+def member_memory(input_file):
+    """Estimate the memory used by one ensemble member.
+
+    The model arrays of input_file are created and counted twice, to
+    leave room for the weight buffers and the routing of parcels.
+
+    Parameters
+    ----------
+    input_file : str
+        Path to the input file.
+
+    Returns
+    -------
+    int
+        Bytes used by a worker process running the model.
+    """
+    model = DeltaRCM(input_file)
+
+    nbytes = sum(v.nbytes for v in vars(model).values()
+                 if isinstance(v, np.ndarray))
+
+    return 2 * nbytes + _process_overhead
+
+
+def pool_size(input_files, n_workers=None):
+    """Number of members to run at the same time.
+
+    At most n_workers (the number of CPUs by default), and no more than
+    fit in the available memory when each worker runs the largest member.
+
+    Parameters
+    ----------
+    input_files : list of str
+        Paths to the input files of the members.
+    n_workers : int, optional
+        Maximum number of worker processes.
+
+    Returns
+    -------
+    int
+        Number of worker processes.
+    """
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    n_workers = min(n_workers, len(input_files))
+
+    memory = available_memory()
+    if memory is not None and input_files:
+        largest = max(member_memory(f) for f in input_files)
+        n_workers = min(n_workers, memory // largest)
+
+    return int(max(n_workers, 1))
+
+
+def run_member(args):
+    """Run one ensemble member and stream its elevation to disk.
+
+    Parameters
+    ----------
+    args : tuple
+        Index of the member, its input file, number of time steps, number
+        of time steps between snapshots and output directory.
+
+    Returns
+    -------
+    tuple
+        Index of the member and path of its .npy file of eta snapshots.
+    """
+    index, input_file, n_steps, save_every, out_dir = args
+
+    model = BmiDeltaRCM()
+    model.initialize(input_file)
+
+    eta = model.get_value_ref('surface__elevation')
+    writer = GridWriter(os.path.join(out_dir, 'eta_grids'), eta.shape,
+                        n_steps // save_every, eta.dtype)
+
+    for step in range(1, n_steps + 1):
+        model.update()
+        if step % save_every == 0:
+            writer.append(model.get_value_ref('surface__elevation'))
+
+    writer.close()
+    model.finalize()
+
+    return index, writer.path
+
+
+class EnsembleStatistics(object):
+
+    """Mean and variance of the snapshots of the members, updated as the
+    members finish (Welford's algorithm).
+
+    The running mean and sum of squared deviations are memory-mapped
+    .npy files, so only one snapshot of one member is in memory at a time.
+    """
+
+    def __init__(self, out_dir, shape, name='eta'):
+        self.n_members = 0
+        self.mean = np.lib.format.open_memmap(
+            os.path.join(out_dir, name + '_mean.npy'), mode='w+', shape=shape)
+        self.var = np.lib.format.open_memmap(
+            os.path.join(out_dir, name + '_var.npy'), mode='w+', shape=shape)
+
+    def add(self, grids):
+        """Add the snapshots of one member.
+
+        Parameters
+        ----------
+        grids : array_like
+            Snapshots of the member, with the shape of the statistics.
+
+        Raises
+        ------
+        ValueError
+            If the shape of grids is not the shape of the statistics.
+        """
+        if np.shape(grids) != self.mean.shape:
+            raise ValueError('member snapshots have shape %s, expected %s'
+                             % (np.shape(grids), self.mean.shape))
+
+        self.n_members += 1
+
+        # var holds the sum of squared deviations until close
+        for i in range(len(grids)):
+            grid = np.asarray(grids[i], dtype=np.float64)
+            delta = grid - self.mean[i]
+            self.mean[i] += delta / self.n_members
+            self.var[i] += delta * (grid - self.mean[i])
+
+    def close(self):
+        """Turn the sum of squared deviations into the sample variance
+        and write the statistics to disk."""
+        if self.n_members > 1:
+            for i in range(len(self.var)):
+                self.var[i] /= self.n_members - 1
+
+        self.mean.flush()
+        self.var.flush()
+
+
+def run_ensemble(input_file, members, n_steps, out_dir, save_every=1,
+                 n_workers=None):
+    """Run an ensemble of deltaRCM realizations.
+
+    Each member runs input_file with its own values of the input keys,
+    in a pool of processes. Its eta snapshots are written to
+    out_dir/member_<index>/eta_grids.npy. The mean and variance of the
+    snapshots over the members are updated as each member finishes and
+    written to out_dir/eta_mean.npy and out_dir/eta_var.npy.
+
+    Parameters
+    ----------
+    input_file : str
+        Path to the base input file.
+    members : list of dict or str
+        Values of the input keys of each member, or the path to a table
+        of them (see read_parameter_table).
+    n_steps : int
+        Number of time steps of each member.
+    out_dir : str
+        Output directory of the ensemble.
+    save_every : int, optional
+        Number of time steps between eta snapshots.
+    n_workers : int, optional
+        Maximum number of members run at the same time (see pool_size).
+
+    Returns
+    -------
+    EnsembleStatistics
+        The statistics of the ensemble.
+    """
+    if isinstance(members, basestring):
+        members = read_parameter_table(members)
+
+    tasks = []
+    for index, params in enumerate(members):
+        member_dir = os.path.join(out_dir, 'member_%04d' % index)
+        if not os.path.exists(member_dir):
+            os.makedirs(member_dir)
+
+        params = dict(params)
+        params.setdefault('model_output__out_dir', member_dir + os.sep)
+
+        member_input = os.path.join(member_dir, 'deltaRCM.in')
+        write_member_input(input_file, params, member_input)
+
+        tasks.append((index, member_input, n_steps, save_every, member_dir))
+
+    pool = multiprocessing.Pool(pool_size([task[1] for task in tasks],
+                                          n_workers))
+
+    stats = None
+    try:
+        for index, path in pool.imap_unordered(run_member, tasks):
+            grids = np.load(path, mmap_mode='r')
+            if stats is None:
+                stats = EnsembleStatistics(out_dir, grids.shape)
+            stats.add(grids)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+    if stats is not None:
+        stats.close()
+
+    return stats
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a deltaRCM ensemble.')
+    parser.add_argument('input_file', help='base input file')
+    parser.add_argument('table', help='table of input values of the members')
+    parser.add_argument('n_steps', type=int, help='time steps of each member')
+    parser.add_argument('out_dir', help='output directory')
+    parser.add_argument('--save-every', type=int, default=1,
+                        help='time steps between eta snapshots')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='maximum number of worker processes')
+
+    args = parser.parse_args()
+
+    run_ensemble(args.input_file, args.table, args.n_steps, args.out_dir,
+                 save_every=args.save_every, n_workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""A small delta that runs in a fraction of a second per time step, for
+tests and benchmarks."""
+
+import os
+
+from .deltaRCM import DeltaRCM
+
+
+small_inputs = {
+    'model_grid__length': 200.,
+    'model_grid__width': 500.,
+    'model_grid__cell_size': 10.,
+    'model__max_iteration': 3,
+    'water__number_parcels': 200,
+    'sediment__number_parcels': 100,
+}
+
+
+def write_input_file(out_dir, **inputs):
+    """Write the input file of the small delta to out_dir/deltaRCM.in.
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory of the input and output files.
+    **inputs
+        Input file values that replace those of the small delta.
+
+    Returns
+    -------
+    str
+        Path to the input file.
+    """
+    values = dict(small_inputs)
+    values['model_output__out_dir'] = out_dir + os.sep
+    values.update(inputs)
+
+    input_file = os.path.join(out_dir, 'deltaRCM.in')
+    with open(input_file, 'w') as f:
+        for key, value in sorted(values.items()):
+            f.write('%s : %s\n' % (key, value))
+
+    return input_file
+
+
+def make_model(out_dir, **inputs):
+    """Create a small DeltaRCM model that writes to out_dir.
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory of the input and output files.
+    **inputs
+        Input file values that replace those of the small delta.
+
+    Returns
+    -------
+    DeltaRCM
+        The new model.
+    """
+    return DeltaRCM(write_input_file(out_dir, **inputs))
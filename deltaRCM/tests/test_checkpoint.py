@@ -0,0 +1,42 @@
+"""Tests of restarting the model from a checkpoint."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from deltaRCM.small_delta import make_model
+
+
+def test_restart_continues_grid_files():
+    """A restarted run appends to the grid files of the first run."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        inputs = {'model_output__opt_eta_grids': 'True',
+                  'model_output__opt_time_interval': 1,
+                  'model__total_timesteps': 6}
+        checkpoint = os.path.join(out_dir, 'state.ckpt')
+        eta_grids = os.path.join(out_dir, 'eta_grids.npy')
+
+        model = make_model(out_dir, **inputs)
+        for step in range(6):
+            model.advance_in_time()
+            if step == 2:
+                model.save_checkpoint(checkpoint)
+        model.finalize()
+
+        expected = np.load(eta_grids)
+        assert expected.shape[0] == 6
+
+        model = make_model(out_dir, **inputs)
+        model.load_checkpoint(checkpoint)
+        for step in range(3):
+            model.advance_in_time()
+        model.finalize()
+
+        grids = np.load(eta_grids)
+        assert grids.shape == expected.shape
+        assert np.all(grids == expected)
+    finally:
+        shutil.rmtree(out_dir)
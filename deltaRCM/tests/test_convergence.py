@@ -0,0 +1,100 @@
+"""Tests of the early exit of the water iterations."""
+
+import shutil
+import tempfile
+
+import numpy as np
+
+from deltaRCM.small_delta import make_model
+
+
+def record_flow_change(model):
+    """Record flow_change after every water iteration but the first of
+    each time step, without stopping the iterations."""
+    changes = []
+    finalize_water_iteration = model.finalize_water_iteration
+    qwn_old = []
+
+    def finalize_and_record(timestep, iteration):
+        if iteration > 0:
+            changes.append(model.flow_change(qwn_old[0]))
+        qwn_old[:] = [model.qwn.copy()]
+        finalize_water_iteration(timestep, iteration)
+
+    model.finalize_water_iteration = finalize_and_record
+
+    return changes
+
+
+def test_change_decreases_while_settling():
+    """The change of the flow drops as the spin up settles and stays low."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        model = make_model(out_dir, model__max_iteration=8,
+                           water__number_parcels=2000)
+        changes = record_flow_change(model)
+
+        model.advance_in_time()
+        spin_up = changes[:]
+        model.advance_in_time()
+        settled = changes[len(spin_up):]
+
+        assert spin_up[0] > 0
+        assert spin_up[-1] < spin_up[0] / 2
+        assert max(settled) < spin_up[0] / 2
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_change_without_sampling_noise():
+    """Routing twice through the same weights gives almost no change,
+    unlike the plain difference of the two routed fields."""
+    for n_parcels in [500, 4000]:
+        out_dir = tempfile.mkdtemp()
+        try:
+            model = make_model(out_dir, water__number_parcels=n_parcels)
+            model.advance_in_time()
+
+            model.init_water_iteration()
+            model.run_water_iteration()
+            qwn_old = model.qwn.copy()
+
+            model.init_water_iteration()
+            model.run_water_iteration()
+
+            plain = np.sqrt(np.sum((model.qwn - qwn_old)**2) / np.sum(qwn_old**2))
+            assert model.flow_change(qwn_old) < plain / 4
+        finally:
+            shutil.rmtree(out_dir)
+
+
+def test_early_exit_after_spin_up():
+    """With any number of parcels, the spin up takes more iterations than
+    the settled time step that follows it."""
+    for n_parcels in [500, 4000]:
+        out_dir = tempfile.mkdtemp()
+        try:
+            model = make_model(out_dir, model__max_iteration=8,
+                               water__number_parcels=n_parcels,
+                               model__convergence_tolerance=0.05)
+
+            model.advance_in_time()
+            spin_up = model.iterations_used
+            model.advance_in_time()
+
+            assert 2 < spin_up
+            assert model.iterations_used < spin_up
+        finally:
+            shutil.rmtree(out_dir)
+
+
+def test_no_early_exit_without_tolerance():
+    """All water iterations run when the tolerance is 0."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        model = make_model(out_dir, model__max_iteration=4)
+        model.advance_in_time()
+
+        assert model.iterations_used == model.itermax
+    finally:
+        shutil.rmtree(out_dir)
@@ -0,0 +1,49 @@
+"""Tests of ensembles of realizations."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from nose.tools import assert_raises
+
+from deltaRCM.ensemble import EnsembleStatistics, run_ensemble
+from deltaRCM.small_delta import write_input_file
+
+
+def test_statistics_match_numpy():
+    """The ensemble mean and variance are those of the member snapshots."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        input_file = write_input_file(out_dir)
+        members = [{'model__random_seed': seed} for seed in (1, 2, 3)]
+
+        stats = run_ensemble(input_file, members, 2, out_dir, n_workers=2)
+
+        grids = np.array([
+            np.load(os.path.join(out_dir, 'member_%04d' % index,
+                                 'eta_grids.npy'))
+            for index in range(len(members))], dtype=np.float64)
+
+        assert stats.n_members == 3
+        assert grids.shape[1] == 2
+        assert np.any(grids.var(axis=0) > 0)
+        assert np.allclose(np.load(os.path.join(out_dir, 'eta_mean.npy')),
+                           grids.mean(axis=0))
+        assert np.allclose(np.load(os.path.join(out_dir, 'eta_var.npy')),
+                           grids.var(axis=0, ddof=1))
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_statistics_shape_mismatch():
+    """Adding snapshots of another shape raises a ValueError."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        stats = EnsembleStatistics(out_dir, (2, 3, 4))
+        stats.add(np.ones((2, 3, 4)))
+
+        assert_raises(ValueError, stats.add, np.ones((1, 3, 4)))
+        assert stats.n_members == 1
+    finally:
+        shutil.rmtree(out_dir)
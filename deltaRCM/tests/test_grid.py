@@ -0,0 +1,31 @@
+"""Tests of grids of different widths."""
+
+import shutil
+import tempfile
+
+import numpy as np
+
+from deltaRCM.small_delta import make_model
+
+
+def test_grid_width_73():
+    """Water reaches the ocean edge of a grid 73 cells wide."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        model = make_model(out_dir, model_grid__width=730.)
+        assert model.W == 73
+
+        model.advance_in_time()
+
+        outlet = model.cell_type == -1
+        assert outlet.any()
+        assert np.all(np.isfinite(model.qw))
+        assert model.qw[outlet].sum() > 0
+
+        # discharge away from the inlet, in the basin
+        assert model.qw[model.L0+2:].sum() > 0
+        ctr = int(model.CTR)
+        assert model.qw[model.L0+2:, :ctr-5].sum() + \
+            model.qw[model.L0+2:, ctr+5:].sum() > 0
+    finally:
+        shutil.rmtree(out_dir)
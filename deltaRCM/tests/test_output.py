@@ -0,0 +1,70 @@
+"""Tests of the output of grids."""
+
+import atexit
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+from nose.tools import assert_raises
+
+from deltaRCM.small_delta import make_model
+
+_run_without_finalize = """
+import sys
+sys.path.insert(0, %r)
+from deltaRCM.small_delta import make_model
+model = make_model(%r, model_output__opt_eta_grids='True',
+                   model_output__opt_time_interval=1,
+                   model__total_timesteps=10)
+for step in range(3):
+    model.advance_in_time()
+"""
+
+
+def test_grids_closed_at_exit():
+    """The queued grids are written and trimmed without finalize."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [sys.executable, '-c', _run_without_finalize % (root, out_dir)],
+                stdout=devnull)
+
+        grids = np.load(os.path.join(out_dir, 'eta_grids.npy'))
+        assert grids.shape[0] == 3
+        assert np.all(np.abs(grids).sum(axis=(1, 2)) > 0)
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_unknown_figure_mode():
+    """An unknown figure mode is rejected when the model is created."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        assert_raises(ValueError, make_model, out_dir,
+                      model_output__figure_mode='jpeg')
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_exit_handler_registered_once():
+    """Reopening the output does not register another exit handler."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        n_handlers = len(atexit._exithandlers)
+
+        model = make_model(out_dir, model_output__opt_eta_grids='True',
+                           model_output__opt_time_interval=1)
+        for step in range(3):
+            model.advance_in_time()
+            model.close_output()
+
+        assert len(atexit._exithandlers) == n_handlers + 1
+    finally:
+        shutil.rmtree(out_dir)
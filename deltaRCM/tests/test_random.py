@@ -0,0 +1,43 @@
+"""Tests of the reproducibility of runs."""
+
+import shutil
+import tempfile
+
+import numpy as np
+
+from deltaRCM.small_delta import make_model
+
+
+def run_two_steps(**inputs):
+    """Run two time steps of the small delta and return eta and qw."""
+    out_dir = tempfile.mkdtemp()
+    try:
+        model = make_model(out_dir, **inputs)
+        model.advance_in_time()
+        model.advance_in_time()
+        model.finalize()
+
+        return model.eta.copy(), model.qw.copy()
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def test_results_do_not_depend_on_workers():
+    """Routing the water parcels in 1 or 3 chunks gives the same results."""
+    eta, qw = run_two_steps(model__number_workers=1)
+    eta_3, qw_3 = run_two_steps(model__number_workers=3)
+
+    assert np.all(eta == eta_3)
+    assert np.all(qw == qw_3)
+
+
+def test_results_depend_only_on_seed():
+    """The same seed gives the same results and another seed does not."""
+    eta, qw = run_two_steps(model__random_seed=11)
+    eta_same, qw_same = run_two_steps(model__random_seed=11)
+    eta_other, qw_other = run_two_steps(model__random_seed=12)
+
+    assert np.all(eta == eta_same)
+    assert np.all(qw == qw_same)
+    assert np.any(eta != eta_other)
+    assert np.any(qw != qw_other)
@@ -0,0 +1,52 @@
+"""Tests of the warm start cache of spun-up flow fields."""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from deltaRCM.small_delta import make_model
+
+
+def run_two_steps(out_dir, cache_dir):
+    """Run two time steps of the small delta with the warm start cache.
+
+    Returns
+    -------
+    tuple
+        The model, the water iterations of its first time step and its
+        eta, qw and stage after the second.
+    """
+    model = make_model(out_dir, model__warm_start_dir=cache_dir)
+
+    model.advance_in_time()
+    iterations = model.iterations_used
+
+    model.advance_in_time()
+
+    return model, iterations, (model.eta, model.qw, model.stage)
+
+
+def test_warm_start_skips_spin_up():
+    """A warm started run skips the spin up and gives the same results."""
+    cache_dir = tempfile.mkdtemp()
+    out_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    try:
+        cold_model, cold_iterations, cold = run_two_steps(out_dirs[0], cache_dir)
+        cache_files = os.listdir(cache_dir)
+        cache_inode = os.stat(cold_model._warm_start_file).st_ino
+
+        warm_model, warm_iterations, warm = run_two_steps(out_dirs[1], cache_dir)
+
+        assert cold_iterations == cold_model.itermax
+        assert warm_iterations == 0
+        assert all(np.all(a == b) for a, b in zip(cold, warm))
+
+        # the cache entry is written once, without leftover temporary files
+        assert len(cache_files) == 1
+        assert os.listdir(cache_dir) == cache_files
+        assert os.stat(warm_model._warm_start_file).st_ino == cache_inode
+    finally:
+        for directory in [cache_dir] + out_dirs:
+            shutil.rmtree(directory)